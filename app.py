@@ -9,7 +9,8 @@ import time
 import random
 from heapq import *
 from flask import Flask, request, Response
-from spotipy import util
+from spotipy import oauth2, util
+from spotiserver.client import PooledSpotify, TokenRefresher
 
 is_running = False
 taking_requests = True
@@ -48,18 +49,24 @@ block_explicit = config['SPOTIFY']['BLOCK_EXPLICIT']
 
 app = Flask(__name__)
 
-token = None
+# authorize once, then share one pooled client whose token is refreshed in
+# the background
+util.prompt_for_user_token(username, oauth_scope, client_id, client_secret, oauth_redirect)
+sp_oauth = oauth2.SpotifyOAuth(client_id, client_secret, oauth_redirect, scope=oauth_scope,
+                               cache_path='.cache-' + username)
+sp = PooledSpotify()
+token_refresher = TokenRefresher(sp_oauth, sp)
+token_refresher.refresh()
+token_refresher.start()
 
 
 @app.route('/')
 def process_request():
     if is_running and taking_requests:
 
-        global total_requests, token
+        global total_requests
 
-        token = util.prompt_for_user_token(username, oauth_scope, client_id, client_secret, oauth_redirect)
-        sp = spotipy.Spotify(auth=token)
-        if token:
+        if token_refresher.ready.is_set():
             listener = request.args['listener']
 
             # Does listener own less than 50% of all requests?
@@ -258,10 +265,6 @@ def playlist_manager():
     first_pass = True
     while True:
         if is_running:
-            global token
-            token = util.prompt_for_user_token(username, oauth_scope, client_id, client_secret, oauth_redirect)
-            sp = spotipy.Spotify(auth=token)
-
             if request_list and taking_requests:
                 song_to_play = request_list.pop()
                 length_of_song = _convert_miliseconds_to_seconds(song_to_play[4])
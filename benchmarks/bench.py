@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Spotiserver benchmarks, run against the offline fake Spotify backend:
+
+    python -m benchmarks.bench [--latency 0.05] [--json baseline.json]
+
+Measures /request throughput and latency, the cost of a request and a pick
+as the party grows, and how many Spotify calls DJ.mix makes per song.
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import time
+from spotiserver import party, scheduler, server
+from spotiserver.client import CallScheduler
+from spotiserver.store import MemoryStore
+from .fake_spotify import FakeSpotify, VirtualClock
+
+
+class Finished(BaseException):
+    """
+    Raised by the virtual clock to stop DJ.mix, which never returns on its own
+    """
+
+
+def make_party(sp, block_explicit=True):
+    fyre = party.Party()
+    fyre.config = {'SPOTIFY': {'SPOTIFY_PLAYLIST_ID': 'bench'}}
+    fyre.sp_oauth = None
+    fyre.store = MemoryStore()
+    fyre.bouncer = party.PercentBouncer(fyre)
+    fyre.intake = None
+    fyre.dj = party.DJ(fyre)
+    fyre.dj._sp = sp
+    fyre.dj.token_refresher.ready.set()
+    fyre.dj.username = 'bench'
+    fyre.dj.playlist = 'bench'
+    fyre.dj.block_explicit = block_explicit
+    fyre.dj.seed_playlist.username = 'bench'
+    fyre.dj.seed_playlist.playlist = FakeSpotify.SEED_PLAYLIST
+    return fyre
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def bench_requests(args):
+    """
+    Throughput and latency of /request, with guests choosing from a catalog
+    of popular songs
+    """
+    scheduler = CallScheduler(rate=args.calls_per_second, burst=args.calls_per_second * 2) if args.calls_per_second else None
+    sp = FakeSpotify(latency=args.latency, jitter=args.latency / 2, error_rate=args.error_rate, scheduler=scheduler)
+    server.app.party = make_party(sp)
+    client = server.app.test_client()
+    rnd = random.Random(0)
+    urls = ['/request?listener=guest{}&track=song{}&artist=artist'.format(rnd.randrange(args.guests), int(rnd.paretovariate(1.2)) % 1000)
+            for i in range(args.requests)]
+
+    def get(url):
+        started = time.perf_counter()
+        status = client.get(url).status_code
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as pool:
+        latencies, statuses = zip(*pool.map(get, urls))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': len(urls),
+        'threads': args.threads,
+        'throughput_per_sec': len(urls) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'spotify_searches': sp.calls['GET search'],
+        'shed': statuses.count(503),
+    }
+
+
+def bench_queue(size, samples=2000):
+    """
+    Cost of one request and one pick once the party has `size` tracks and
+    `size` guests
+    """
+    fyre = make_party(FakeSpotify())
+    store = fyre.store
+    for i in range(size):
+        guest_key, track_id = 'guest{}'.format(i), 'track{}'.format(i)
+        store.count_request(guest_key)
+        store.add_vote(track_id, guest_key)
+        store.enqueue(track_id)
+
+    # warm the search cache so only our own work is measured
+    titles = ['song{}'.format(i) for i in range(100)]
+    for title in titles:
+        fyre.dj.search(title)
+
+    rnd = random.Random(size)
+    started = time.perf_counter()
+    for i in range(samples):
+        try:
+            fyre.bouncer.request('guest{}'.format(rnd.randrange(size)), rnd.choice(titles), None)
+        except party.PartyFoul:
+            pass
+    request_us = (time.perf_counter() - started) / samples * 1e6
+
+    started = time.perf_counter()
+    for i in range(samples):
+        store.pop_track()
+    pick_us = (time.perf_counter() - started) / samples * 1e6
+
+    return {'size': size, 'request_us': request_us, 'pick_us': pick_us}
+
+
+def bench_mix(hours):
+    """
+    Spotify calls DJ.mix makes per song over `hours` of simulated playback
+    """
+    clock = VirtualClock()
+    end = clock.time() + hours * 3600
+
+    class Time:
+        @staticmethod
+        def time():
+            return clock.time()
+
+        @staticmethod
+        def sleep(seconds):
+            clock.sleep(seconds)
+            if clock.time() > end:
+                raise Finished
+
+    sp = FakeSpotify(clock=clock)
+    fyre = make_party(sp)
+    patched = party.time, scheduler.time
+    party.time = scheduler.time = Time
+    try:
+        fyre.dj.mix()
+    except Finished:
+        pass
+    finally:
+        party.time, scheduler.time = patched
+
+    songs = max(sp.playing, 1)
+    return {
+        'hours': hours,
+        'songs_played': sp.playing,
+        'calls_per_song': sum(sp.calls.values()) / songs,
+        'calls': dict(sp.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help="mean seconds per fake Spotify call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of fake Spotify calls that fail")
+    parser.add_argument('--calls-per-second', type=float, default=0, help="pace Spotify calls like SPOTIFY_CALLS_PER_SECOND (default: unlimited)")
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--guests', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--hours', type=float, default=4)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = {}
+
+    results['request'] = r = bench_requests(args)
+    print("/request: {requests} requests on {threads} threads: {throughput_per_sec:.0f}/s, "
+          "p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms, {spotify_searches} Spotify searches, {shed} shed".format(**r))
+
+    results['queue'] = []
+    for size in args.sizes:
+        r = bench_queue(size)
+        results['queue'].append(r)
+        print("party of {size}: {request_us:.1f} us per request, {pick_us:.1f} us per pick".format(**r))
+
+    results['mix'] = r = bench_mix(args.hours)
+    print("DJ.mix: {songs_played} songs in {hours} hours, {calls_per_song:.2f} Spotify calls per song {calls}".format(**r))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
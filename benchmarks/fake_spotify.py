@@ -0,0 +1,157 @@
+#!/usr/bin/env false
+"""
+Offline stand-in for the parts of the Spotify Web API that Spotiserver uses,
+with configurable latency and error rates
+"""
+import collections
+import hashlib
+import random
+import threading
+import time
+import spotipy
+from spotiserver.client import CallScheduler, PooledSpotify
+
+
+class VirtualClock:
+    """
+    Clock whose sleeps return immediately, for simulating hours of playback
+    in a few seconds. Patch it over the `time` module of the code under test.
+    """
+
+    def __init__(self, start=1000000.0):
+        self.now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += max(seconds, 0)
+
+
+class FakeSpotify(PooledSpotify):
+    """
+    Spotify client that answers from a synthetic catalog instead of the
+    network. Every call goes through spotipy's real request building, and is
+    counted per endpoint in `calls`. The party playlist starts out empty; the
+    playlist `SEED_PLAYLIST` holds a fixed set of tracks to seed
+    recommendations with.
+
+    :param latency: mean seconds each call takes
+    :param jitter: each call takes latency +/- up to this many seconds
+    :param error_rate: fraction of calls that fail with `error_status`
+    :param explicit_rate: fraction of the catalog that is explicit
+    :param scheduler: paces calls like the real client; unlimited by default
+    """
+
+    SEED_PLAYLIST = 'seeds'
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=429,
+                 explicit_rate=0.1, clock=None, seed=0, scheduler=None):
+        super().__init__(auth='fake-token', scheduler=scheduler or CallScheduler(rate=1e9, burst=1e9))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.explicit_rate = explicit_rate
+        self.clock = clock or time
+        self.calls = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # the party playlist and where playback is in it
+        self.playlist = []
+        self.snapshot = 0
+        self.playing = 0
+        self.track_started = None
+
+    def track(self, track_id):
+        digest = hashlib.md5(track_id.encode()).digest()
+        return {
+            'id': track_id,
+            'name': 'Track {}'.format(track_id[:8]),
+            'uri': 'spotify:track:' + track_id,
+            'explicit': digest[0] < 256 * self.explicit_rate,
+            'duration_ms': 150000 + int.from_bytes(digest[1:3], 'big') % 150000,
+            'artists': [{'id': 'artist' + track_id[:6], 'name': 'Artist {}'.format(track_id[:6])}],
+        }
+
+    def _track_id(self, text):
+        return hashlib.md5(text.lower().encode()).hexdigest()[:22]
+
+    def _call(self, method, url, payload, params):
+        endpoint = self._endpoint(method, url)
+        with self._lock:
+            self.calls[endpoint] += 1
+            delay = max(self.latency + self._random.uniform(-self.jitter, self.jitter), 0)
+            fail = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise spotipy.client.SpotifyException(self.error_status, -1, '{}:\n simulated error'.format(url),
+                                                  headers={'Retry-After': '1'})
+        return getattr(self, '_' + endpoint.replace('/', '_').replace(' ', '_'))(url, payload, params)
+
+    @staticmethod
+    def _endpoint(method, url):
+        path = url.split('?')[0]
+        if path.startswith('users/'):
+            return '{} playlist_tracks'.format(method) if path.endswith('/tracks') else 'GET playlist'
+        return '{} {}'.format(method, path)
+
+    def _GET_search(self, url, payload, params):
+        query = params['q']
+        if 'nothing' in query:
+            return {'tracks': {'items': [], 'total': 0}}
+        return {'tracks': {'items': [self.track(self._track_id(query))], 'total': 1}}
+
+    def _GET_recommendations(self, url, payload, params):
+        seed = params.get('seed_tracks', '')
+        return {'tracks': [self.track(self._track_id('{}:{}'.format(seed, i))) for i in range(params.get('limit', 20))]}
+
+    def _GET_playlist(self, url, payload, params):
+        if url.endswith('/' + self.SEED_PLAYLIST):
+            return {
+                'snapshot_id': 'seed',
+                'tracks': {'items': [{'track': {'id': self._track_id('seed{}'.format(i))}} for i in range(50)]},
+            }
+        return {
+            'snapshot_id': str(self.snapshot),
+            'tracks': {'items': [{'track': {'id': track_id}} for track_id in self.playlist[:100]], 'total': len(self.playlist)},
+        }
+
+    def _GET_playlist_tracks(self, url, payload, params):
+        offset, limit = params.get('offset', 0), params.get('limit', 100)
+        return {
+            'total': len(self.playlist),
+            'items': [{'track': self.track(track_id)} for track_id in self.playlist[offset:offset + limit]],
+        }
+
+    def _POST_playlist_tracks(self, url, payload, params):
+        with self._lock:
+            self.playlist.extend(uri.split(':')[-1] for uri in payload)
+            self.snapshot += 1
+            if self.track_started is None:
+                self.track_started = self.clock.time()
+        return {'snapshot_id': str(self.snapshot)}
+
+    def _GET_me_player(self, url, payload, params):
+        with self._lock:
+            if self.track_started is None:
+                return None
+            # move playback along to the track that is playing now
+            now = self.clock.time()
+            while self.playing < len(self.playlist) - 1:
+                duration = self.track(self.playlist[self.playing])['duration_ms'] / 1000
+                if now - self.track_started < duration:
+                    break
+                self.track_started += duration
+                self.playing += 1
+            item = self.track(self.playlist[self.playing])
+            progress_ms = min(int((now - self.track_started) * 1000), item['duration_ms'])
+        return {
+            'is_playing': True,
+            'progress_ms': progress_ms,
+            'item': item,
+            'context': {'type': 'playlist', 'uri': 'spotify:playlist:bench', 'href': ''},
+        }
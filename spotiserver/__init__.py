@@ -2,8 +2,18 @@ import logging
 import coloredlogs
 import configparser
 import threading
+from . import metrics
+from . import tracing
 from . import party
 from . import server
+from .intake import Intake
+from .admission import RecentRequests, SlidingWindow
+from .cache import SearchCache
+from .catalog import TrackCatalog
+from .client import CallScheduler
+from .history import PlayedHistory
+from .store import MemoryStore, SQLiteStore
+from .journal import Journal
 import spotipy.oauth2
 
 
@@ -14,11 +24,42 @@ def validate_config(config):
     assert 'CLIENT_SECRET' in config['SPOTIFY']
 
 
-def main():
-    coloredlogs.install(level=logging.INFO)
-
+def read_config(path='spotiserver.ini'):
     config = configparser.RawConfigParser()
-    config.read('spotiserver.ini')
+    config.read(path)
+    return config
+
+
+def create_store(config):
+    """
+    Pick where party state lives. A SQLite store lets several worker
+    processes serve the same party.
+    """
+    # votes lose half their weight every VOTE_HALF_LIFE seconds, if set
+    half_life = float(config['SPOTIFY'].get('VOTE_HALF_LIFE', 0))
+    if half_life:
+        logging.info("Votes lose half their weight every {} seconds.".format(half_life))
+
+    if config['SPOTIFY'].get('STATE_STORE', 'memory').lower() == 'sqlite':
+        path = config['SPOTIFY'].get('STATE_PATH', 'spotiserver.db')
+        logging.info("Party state is shared through {}.".format(path))
+        store = SQLiteStore(path)
+        store.half_life = half_life
+        return store
+
+    store = MemoryStore()
+    store.half_life = half_life
+    journal_path = config['SPOTIFY'].get('JOURNAL_PATH')
+    if journal_path:
+        # pick up where the party left off, then log every change from here on
+        journal = Journal(journal_path)
+        journal.recover(store)
+        store.journal = journal
+        journal.start(store)
+    return store
+
+
+def create_party(config):
     client_id = config['SPOTIFY']['CLIENT_ID']
     client_secret = config['SPOTIFY']['CLIENT_SECRET']
     oauth_scope = config['SPOTIFY']['OAUTH_SCOPE']
@@ -33,8 +74,24 @@ def main():
     else:
         logging.warning("EXPLICIT TRACKS WILL NOT BE BLOCKED.")
 
+    trace_path = config['SPOTIFY'].get('TRACE_PATH')
+    if trace_path:
+        tracing.configure(
+            trace_path,
+            sample_rate=float(config['SPOTIFY'].get('TRACE_SAMPLE_RATE', 0.01)),
+            max_bytes=int(config['SPOTIFY'].get('TRACE_MAX_BYTES', 10 * 1024 * 1024)),
+            backups=int(config['SPOTIFY'].get('TRACE_BACKUPS', 3))
+        )
+        logging.info("Tracing requests to {}.".format(trace_path))
+
     fyre = party.Party()
+    fyre.store = create_store(config)
     fyre.bouncer = party.PercentBouncer(fyre)
+    fyre.bouncer.rate_limit = SlidingWindow(
+        limit=int(config['SPOTIFY'].get('GUEST_REQUEST_LIMIT', 10)),
+        window=int(config['SPOTIFY'].get('GUEST_REQUEST_WINDOW', 60))
+    )
+    fyre.bouncer.recent_requests = RecentRequests(ttl=int(config['SPOTIFY'].get('SEARCH_CACHE_TTL', 600)))
     fyre.config = config
 
     fyre.sp_oauth = spotipy.oauth2.SpotifyOAuth(
@@ -47,14 +104,57 @@ def main():
         proxies=None
     )
 
-    fyre.dj = party.DJ(fyre)
+    scheduler = CallScheduler(
+        rate=float(config['SPOTIFY'].get('SPOTIFY_CALLS_PER_SECOND', 10)),
+        burst=int(config['SPOTIFY'].get('SPOTIFY_CALL_BURST', 20)),
+        search_wait=float(config['SPOTIFY'].get('SEARCH_MAX_WAIT', 2))
+    )
+    fyre.dj = party.DJ(fyre, pool_size=int(config['SPOTIFY'].get('SPOTIFY_POOL_SIZE', 10)), scheduler=scheduler)
     fyre.dj.username = username
     fyre.dj.playlist = playlist
     fyre.dj.block_explicit = block_explicit
+    fyre.dj.seed_playlist.username = config['SPOTIFY'].get('RECOMMENDED_PLAYLIST_USERNAME') or username
+    fyre.dj.seed_playlist.playlist = config['SPOTIFY'].get('RECOMMENDED_PLAYLIST_ID') or playlist
+    fyre.dj.catalog = TrackCatalog(size=int(config['SPOTIFY'].get('TRACK_CATALOG_SIZE', 20000)))
+    fyre.dj.history = PlayedHistory(size=int(config['SPOTIFY'].get('PLAYED_HISTORY_SIZE', 200)), store=fyre.store)
+    fyre.dj.search_cache = SearchCache(
+        size=int(config['SPOTIFY'].get('SEARCH_CACHE_SIZE', 1024)),
+        ttl=int(config['SPOTIFY'].get('SEARCH_CACHE_TTL', 600)),
+        negative_ttl=int(config['SPOTIFY'].get('SEARCH_CACHE_NEGATIVE_TTL', 60))
+    )
+
+    # resolve requests in the background and hand guests a ticket instead
+    fyre.intake = None
+    if config['SPOTIFY'].get('ASYNC_REQUESTS', '').lower() in ['true', 'yes', 't']:
+        fyre.intake = Intake(fyre, workers=int(config['SPOTIFY'].get('INTAKE_WORKERS', 4)),
+                             max_pending=int(config['SPOTIFY'].get('INTAKE_MAX_PENDING', 1000)))
+        logging.info("Requests will be processed asynchronously.")
+
+    return fyre
+
+
+def start_party(fyre):
+    # keep the DJ's Spotify token fresh in the background
+    fyre.dj.token_refresher.start()
 
     # tell the DJ to start mixing tracks
-    threading.Thread(target=fyre.dj.mix).start()
+    threading.Thread(target=fyre.dj.mix, daemon=True).start()
 
-    # start the Flask server to handle requests
+    export_metrics(fyre)
     server.app.party = fyre
-    server.app.run(host="0.0.0.0", port=5000)
+
+
+def export_metrics(fyre):
+    metrics.QUEUE_DEPTH.set_function(fyre.store.queue_length)
+    metrics.TRACKS.set_function(fyre.store.track_count)
+    metrics.GUESTS.set_function(fyre.store.guest_count)
+    metrics.VIEWERS.set_function(lambda: fyre.dj.feed.viewers)
+
+
+def main():
+    coloredlogs.install(level=logging.INFO)
+
+    start_party(create_party(read_config()))
+
+    # start the Flask server to handle requests
+    server.app.run(host="0.0.0.0", port=5000, threaded=True)
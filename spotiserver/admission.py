@@ -0,0 +1,92 @@
+#!/usr/bin/env false
+import collections
+import threading
+import time
+
+
+class SlidingWindow:
+    """
+    Per-key limit of `limit` events in any `window` seconds. The window is
+    approximated from the counts in the current and previous fixed windows,
+    so each check is O(1) and each key costs three numbers.
+    """
+
+    def __init__(self, limit=10, window=60):
+        self.limit = limit
+        self.window = window
+        # key -> [fixed window index, count in the previous window, count in this one]
+        self._counts = {}
+        self._pruned = 0
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """
+        Count an event for the key, unless it is over the limit
+
+        :rtype: bool
+        """
+        now = time.time()
+        index, elapsed = divmod(now, self.window)
+        index = int(index)
+        with self._lock:
+            if index != self._pruned:
+                self._prune(index)
+            entry = self._counts.get(key)
+            if entry is None:
+                entry = self._counts[key] = [index, 0, 0]
+            elif entry[0] != index:
+                entry[1] = entry[2] if entry[0] == index - 1 else 0
+                entry[2] = 0
+                entry[0] = index
+            # the part of the previous window that still overlaps this one
+            if entry[1] * (1 - elapsed / self.window) + entry[2] >= self.limit:
+                return False
+            entry[2] += 1
+            return True
+
+    def _prune(self, index):
+        # once per window, forget keys that have nothing left in it
+        self._counts = {key: entry for key, entry in self._counts.items() if entry[0] >= index - 1}
+        self._pruned = index
+
+
+class RecentRequests:
+    """
+    Bounded LRU map from a guest's recent requests, by normalized query, to
+    the track they resolved to, so a repeated request can be judged without
+    searching again
+    """
+
+    def __init__(self, size=10000, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        # (guest key, query key) -> (expiration, TrackInfo), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, guest_key, key):
+        """
+        :return: the track's TrackInfo, or None if the guest has not made
+        this request recently
+        :rtype: TrackInfo
+        """
+        with self._lock:
+            entry = self._entries.get((guest_key, key))
+            if entry is None:
+                return None
+            expiration, info = entry
+            if expiration <= time.time():
+                del self._entries[(guest_key, key)]
+                return None
+            self._entries.move_to_end((guest_key, key))
+            return info
+
+    def put(self, guest_key, key, info):
+        with self._lock:
+            self._entries[(guest_key, key)] = (time.time() + self.ttl, info)
+            self._entries.move_to_end((guest_key, key))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
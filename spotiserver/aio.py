@@ -0,0 +1,357 @@
+#!/usr/bin/env false
+"""
+Non-blocking counterparts of the DJ's Spotify calls, for the asyncio serving
+mode in `spotiserver.asgi`. Requires httpx.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import random
+import time
+import httpx
+import spotipy
+from . import metrics, tracing
+from .cache import SearchCache
+from .client import CallScheduler, PooledSpotify, endpoint_name
+from .client import RateLimited
+from .party import PartyFoul
+
+logger = logging.getLogger(__name__)
+
+
+async def blocking(func, *args):
+    """
+    Run a blocking call, e.g. into a SQLiteStore, in the loop's executor so
+    it does not hold up the event loop. The call stays part of the current
+    trace.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+
+class AsyncSpotify:
+    """
+    Spotify client for coroutines, over a pool of kept-alive HTTP connections.
+    Calls are paced, retried and measured like PooledSpotify's. Only the calls
+    the party makes are implemented, with spotipy's signatures.
+    """
+
+    prefix = 'https://api.spotify.com/v1/'
+    RETRIES = PooledSpotify.RETRIES
+
+    def __init__(self, pool_size=10, scheduler=None, timeout=10):
+        self._auth = None
+        self.scheduler = scheduler or CallScheduler()
+        self._session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout)
+
+    def set_auth(self, token):
+        self._auth = token
+
+    async def close(self):
+        await self._session.aclose()
+
+    async def _internal_call(self, method, url, payload, params):
+        endpoint = endpoint_name(url, self.prefix)
+        priority = self.scheduler.priority(method, endpoint)
+        attempt = 0
+        with tracing.span('spotify', method=method, endpoint=endpoint) as span:
+            while True:
+                with tracing.span('scheduler'):
+                    await self.scheduler.acquire_async(priority)
+                try:
+                    return await self._timed_call(method, endpoint, url, payload, params)
+                except spotipy.client.SpotifyException as e:
+                    attempt += 1
+                    span.set('attempts', attempt + 1)
+                    delay = self.scheduler.retry_delay(priority, method, e, attempt, self.RETRIES)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+    async def _timed_call(self, method, endpoint, url, payload, params):
+        started = time.time()
+        status = 'ok'
+        try:
+            return await self._call(method, url, payload, params)
+        except spotipy.client.SpotifyException as e:
+            status = str(e.http_status)
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.SPOTIFY_LATENCY.observe(time.time() - started, method, endpoint, status)
+
+    async def _call(self, method, url, payload, params):
+        if not url.startswith('http'):
+            url = self.prefix + url
+        headers = {'Content-Type': 'application/json'}
+        if self._auth:
+            headers['Authorization'] = 'Bearer {}'.format(self._auth)
+        params = {key: value for key, value in params.items() if value is not None}
+        content = json.dumps(payload) if payload else None
+
+        r = await self._session.request(method, url, params=params, headers=headers, content=content)
+
+        if r.status_code >= 400:
+            message = 'error'
+            if r.text and r.text != 'null':
+                try:
+                    message = r.json()['error']['message']
+                except (ValueError, KeyError, TypeError):
+                    pass
+            raise spotipy.client.SpotifyException(r.status_code, -1, '{}:\n {}'.format(r.url, message), headers=r.headers)
+
+        if r.text and r.text != 'null':
+            return r.json()
+        return None
+
+    async def _get(self, url, args=None, payload=None, **kwargs):
+        if args:
+            kwargs.update(args)
+        return await self._internal_call('GET', url, payload, kwargs)
+
+    async def _post(self, url, args=None, payload=None, **kwargs):
+        if args:
+            kwargs.update(args)
+        return await self._internal_call('POST', url, payload, kwargs)
+
+    async def search(self, q, limit=10, offset=0, type='track', market=None):
+        return await self._get('search', q=q, limit=limit, offset=offset, type=type, market=market)
+
+    async def recommendations(self, seed_tracks=None, limit=20):
+        return await self._get('recommendations', seed_tracks=','.join(seed_tracks), limit=limit)
+
+    async def user_playlist(self, user, playlist_id, fields=None):
+        return await self._get("users/{}/playlists/{}".format(user, playlist_id), fields=fields)
+
+    async def user_playlist_tracks(self, user, playlist_id, fields=None, limit=100, offset=0, market=None):
+        return await self._get("users/{}/playlists/{}/tracks".format(user, playlist_id),
+                               limit=limit, offset=offset, fields=fields, market=market)
+
+    async def user_playlist_add_tracks(self, user, playlist_id, tracks, position=None):
+        return await self._post("users/{}/playlists/{}/tracks".format(user, playlist_id),
+                                payload=['spotify:track:' + track_id for track_id in tracks], position=position)
+
+
+class AsyncDJ:
+    """
+    Runs a DJ from an event loop: guest searches and the mix loop wait on
+    Spotify without holding a thread each. The caches, catalog, schedule,
+    recommendation pool and store are the DJ's own, so both serving modes
+    behave the same. Calls into the store run in the loop's executor, since
+    a SQLiteStore may wait on the disk or on other processes.
+    """
+
+    def __init__(self, dj, sp):
+        self.dj = dj
+        self._sp = sp
+        # search key -> Future of the search in flight
+        self._searches = {}
+        self._refill = None
+
+    @property
+    def sp(self):
+        if not self.dj.token_refresher.ready.is_set():
+            raise PartyFoul("The party host has not logged in to Spotify yet.")
+        return self._sp
+
+    async def refresh_tokens(self):
+        """
+        Keep the client's OAuth token fresh, like TokenRefresher.run. The
+        refresh itself is blocking, so it runs in the loop's executor.
+        """
+        loop = asyncio.get_running_loop()
+        refresher = self.dj.token_refresher
+        while True:
+            try:
+                delay = await loop.run_in_executor(None, refresher.refresh)
+            except Exception:
+                logger.exception("Failed to refresh the Spotify access token; retrying in {} seconds.".format(refresher.RETRY))
+                delay = refresher.RETRY
+            await asyncio.sleep(delay)
+
+    async def search(self, title, artist=None):
+        """
+        Like DJ.search: identical searches in flight share one call
+        """
+        with tracing.span('search') as span:
+            return await self._search(title, artist, span)
+
+    async def _search(self, title, artist, span):
+        dj = self.dj
+        key = SearchCache.key(title, artist)
+        hit, info = dj.search_locally(key, title, artist, span)
+        if hit:
+            return info
+
+        future = self._searches.get(key)
+        if future is not None:
+            span.set('source', 'shared')
+            dj.searches_in_flight.shared += 1
+            return await asyncio.shield(future)
+
+        span.set('source', 'spotify')
+        future = self._searches[key] = asyncio.get_running_loop().create_future()
+        try:
+            search_results = await self.sp.search(dj.search_query(title, artist), 10, type='track')
+            info = dj.search_result(key, search_results)
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody else may be waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(info)
+            return info
+        finally:
+            del self._searches[key]
+
+    async def find_track(self, title, artist=None):
+        try:
+            requested_track = await self.search(title, artist)
+        except RateLimited as e:
+            raise self.dj.busy(e)
+        return self.dj.check_found(requested_track, title, artist)
+
+    async def request(self, guest_key, title, artist=None):
+        """
+        Like PercentBouncer.request
+        """
+        bouncer = self.dj.party.bouncer
+        with tracing.trace('request', guest=guest_key) as span:
+            try:
+                key = SearchCache.key(title, artist)
+                requested_track = await blocking(bouncer.screen, guest_key, key)
+                if requested_track is None:
+                    requested_track = await self.find_track(title, artist)
+                    bouncer.recent_requests.put(guest_key, key, requested_track)
+                await blocking(bouncer.admit, guest_key, requested_track)
+            except PartyFoul as e:
+                span.set('outcome', bouncer.count_outcome(e))
+                raise
+            span.set('outcome', bouncer.count_outcome(None))
+
+    async def request_batch(self, requests):
+        """
+        Like PercentBouncer.request_batch, with the searches made concurrently
+        """
+        bouncer = self.dj.party.bouncer
+
+        async def find(title, artist):
+            try:
+                return await self.find_track(title, artist)
+            except PartyFoul as e:
+                return e
+
+        with tracing.trace('request_batch', size=len(requests)):
+            results, recalled, searches = await blocking(bouncer.screen_batch, requests)
+            found = await asyncio.gather(*(find(title, artist) for title, artist in searches.values()))
+            return await blocking(bouncer.admit_batch, requests, results, recalled, dict(zip(searches, found)))
+
+    async def remaining_playback(self):
+        return self.dj.check_playback(await self.sp._get("me/player"))
+
+    async def last_tracks(self, num=10, current=None):
+        dj = self.dj
+        playlist_data = await self.sp.user_playlist(dj.username, dj.playlist, fields=dj.mirror.FIELDS)
+        if not dj.mirror.current(playlist_data, current):
+            tracks = await self.sp.user_playlist_tracks(dj.username, playlist_id=dj.playlist, limit=dj.mirror.size,
+                                                        offset=dj.mirror.offset(playlist_data))
+            dj.load_mirror(playlist_data, tracks)
+        return dj.mirror.tail(num)
+
+    async def recommend_tracks(self):
+        seed_playlist = self.dj.seed_playlist
+        playlist_data = await self.sp.user_playlist(seed_playlist.username, seed_playlist.playlist, fields=seed_playlist.SNAPSHOT_FIELDS)
+        if playlist_data['snapshot_id'] != seed_playlist.snapshot_id:
+            seed_playlist.update(await self.sp.user_playlist(seed_playlist.username, seed_playlist.playlist, fields=seed_playlist.TRACK_FIELDS))
+        track_list = [random.choice(seed_playlist.track_ids) for i in range(0, 5)]
+
+        recommendation_list = (await self.sp.recommendations(seed_tracks=track_list))['tracks']
+        return self.dj.remember(recommendation_list)
+
+    async def refill_recommendations(self):
+        pool = self.dj.recommendations
+        try:
+            while len(pool) < pool.LOW_WATER:
+                if not pool.add(await self.recommend_tracks()):
+                    raise Exception("Spotify did not recommend any playable tracks")
+        except Exception:
+            logger.exception("Failed to refill the recommendation pool.")
+        finally:
+            self._refill = None
+
+    async def pick_track(self):
+        with tracing.span('pick_track'):
+            return await self._pick_track()
+
+    async def _pick_track(self):
+        dj = self.dj
+        track_id = await blocking(dj.pick_requested_track)
+        if not track_id:
+            pool = dj.recommendations
+            info = pool.take()
+            while info is None:
+                if not pool.add(await self.recommend_tracks()):
+                    raise Exception("Spotify did not recommend any playable tracks")
+                info = pool.take()
+            track_id = dj.pick_recommended_track(info)
+            # top the pool up in the background, like the pool's own thread
+            if len(pool) < pool.LOW_WATER and self._refill is None:
+                self._refill = asyncio.ensure_future(self.refill_recommendations())
+
+        result = await self.sp.user_playlist_add_tracks(dj.username, dj.playlist, [track_id])
+        await blocking(dj.added, track_id, result)
+        return track_id
+
+    async def mix(self):
+        """
+        DJ.mix as a coroutine
+        """
+        dj = self.dj
+        while not dj.token_refresher.ready.is_set():
+            await asyncio.sleep(1)
+        while not await blocking(dj.lead, dj.LEADER_TTL):
+            await asyncio.sleep(dj.LEADER_TTL / 2)
+        logger.info("DJ {} is leading the party.".format(dj.dj_id))
+        await self.pick_track()
+
+        while True:
+            try:
+                with tracing.trace('mix'):
+                    if not await blocking(dj.lead, dj.LEADER_TTL):
+                        logger.warning("Another DJ is leading the party; waiting {} seconds.".format(dj.LEADER_TTL / 2))
+                        dj.schedule.reset()
+                        await asyncio.sleep(dj.LEADER_TTL / 2)
+                        continue
+
+                    if not dj.schedule.synced:
+                        remaining_sec, track_id = await self.remaining_playback()
+                        tail = await self.last_tracks(num=dj.schedule.lookahead + 1, current=track_id)
+                        await blocking(dj.sync, track_id, remaining_sec, tail)
+
+                    # keep enough tracks lined up behind the current one
+                    while dj.schedule.needs_track():
+                        dj.schedule.add(await self.pick_track())
+
+                    # sleep until the current track is over, holding on to the
+                    # party until then
+                    sleep_sec = dj.schedule.time_left() + 2
+                    await blocking(dj.lead, sleep_sec + dj.LEADER_TTL)
+                    await blocking(dj.log_status, sleep_sec)
+                    with tracing.span('sleep'):
+                        await asyncio.sleep(sleep_sec)
+
+                    # check that the track we expected is the one playing now
+                    remaining_sec, track_id = await self.remaining_playback()
+                    if not dj.schedule.advance(track_id, remaining_sec):
+                        logger.warning("Playback does not match the schedule; re-reading the playlist.")
+                    await blocking(dj.announce)
+
+            except Exception:
+                dj.schedule.reset()
+                logger.exception("DJ caught error while mixing; sleeping 5 seconds.")
+                await asyncio.sleep(5)
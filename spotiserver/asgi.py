@@ -0,0 +1,303 @@
+#!/usr/bin/env false
+"""
+Entry point for ASGI servers, e.g.
+
+    uvicorn spotiserver.asgi:app --host 0.0.0.0 --port 5000
+
+Serves the same routes as `spotiserver.server`, from a single event loop:
+guest searches and the DJ's calls to Spotify wait on a pooled HTTP client
+instead of holding a thread each. Requires httpx.
+"""
+import asyncio
+import json
+import logging
+import os
+import urllib.parse
+import coloredlogs
+from . import create_party, export_metrics, metrics, read_config
+from .aio import AsyncDJ, AsyncSpotify, blocking
+from .client import TokenRefresher
+from .intake import IntakeFull
+from .party import PartyFoul, SpotifyBusy
+from .server import MAX_BATCH, valid_request
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+class Response:
+
+    def __init__(self, response=b'', status=200, mimetype='application/json', headers=None):
+        self.response = response
+        self.status = status
+        self.headers = [(b'content-type', mimetype.encode())]
+        for name, value in (headers or {}).items():
+            self.headers.append((name.lower().encode(), value.encode()))
+
+    async def send(self, send, receive):
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': self.headers})
+        if isinstance(self.response, (str, bytes)):
+            body = self.response.encode() if isinstance(self.response, str) else self.response
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        # stream the async generator until the client goes away; the server
+        # only says so through receive(), so listen for that alongside
+        stream = asyncio.ensure_future(self.stream(send))
+        disconnect = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await asyncio.wait((stream, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stream.cancel()
+            disconnect.cancel()
+            await asyncio.gather(stream, disconnect, return_exceptions=True)
+            await self.response.aclose()
+        if not stream.cancelled() and stream.exception() is not None:
+            raise stream.exception()
+
+    async def stream(self, send):
+        async for chunk in self.response:
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+def redirect(location):
+    return Response(status=302, mimetype='text/plain', headers={'Location': location})
+
+
+class Request:
+
+    def __init__(self, scope, receive):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(urllib.parse.parse_qsl(scope.get('query_string', b'').decode(), keep_blank_values=True))
+        self.headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+        self._receive = receive
+
+    async def body(self):
+        chunks = []
+        while True:
+            message = await self._receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def get_json(self):
+        try:
+            return json.loads(await self.body())
+        except ValueError:
+            return None
+
+
+class App:
+    """
+    A minimal ASGI application for the party. The party is created at
+    startup, with an AsyncDJ driving it.
+    """
+
+    def __init__(self):
+        self.party = None
+        self.sp = None
+        self.dj = None
+        # background tasks, kept so they are not garbage collected mid-flight
+        self._tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            response = await self.dispatch(Request(scope, receive))
+            await response.send(send, receive)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for task in list(self._tasks):
+                    task.cancel()
+                if self.sp:
+                    await self.sp.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def startup(self):
+        coloredlogs.install(level=logging.INFO)
+        fyre = create_party(read_config())
+        self.sp = AsyncSpotify(pool_size=int(fyre.config['SPOTIFY'].get('SPOTIFY_POOL_SIZE', 10)),
+                               scheduler=fyre.dj._sp.scheduler)
+        # the DJ's calls to Spotify all go through the async client
+        fyre.dj.token_refresher = TokenRefresher(fyre.sp_oauth, self.sp)
+        self.dj = AsyncDJ(fyre.dj, self.sp)
+        self.party = fyre
+        export_metrics(fyre)
+
+        self.spawn(self.dj.refresh_tokens())
+        self.spawn(self.dj.mix())
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def dispatch(self, request):
+        path = request.path.rstrip('/') or '/'
+        if request.method == 'POST':
+            if path == '/requests':
+                return await self.process_requests(request)
+            return Response(status=405, mimetype='text/plain')
+        if path == '/':
+            return self.index()
+        if path == '/webapp':
+            return redirect('/auth')
+        if path == '/auth':
+            return redirect(self.party.sp_oauth.get_authorize_url())
+        if path == '/callback':
+            return await self.callback(request)
+        if path == '/request':
+            return await self.process_request(request)
+        if path.startswith('/request/'):
+            return self.request_status(path[len('/request/'):])
+        if path == '/queue':
+            return await self.queue(request)
+        if path == '/queue/events':
+            return self.queue_events(request)
+        if path == '/metrics':
+            return Response(response=metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+        return Response(status=404, mimetype='text/plain')
+
+    def index(self):
+        with open(os.path.join(TEMPLATES, 'index.html')) as f:
+            return Response(response=f.read(), status=200, mimetype='text/html')
+
+    async def callback(self, request):
+        if 'code' not in request.args:
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": "Missing code"
+            }), status=400)
+
+        # the OAuth exchange blocks, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.party.sp_oauth.get_access_token, request.args['code'])
+        await loop.run_in_executor(None, self.party.dj.token_refresher.refresh)
+
+        return Response(response=json.dumps({
+            "ok": True,
+            "message": "Successfully authenticated"
+        }), status=200)
+
+    async def process_request(self, request):
+        if not all(arg in request.args for arg in ('listener', 'track', 'artist')):
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": "Expected a listener, a track and an artist"
+            }), status=400)
+        listener = request.args['listener']
+        track = request.args['track']
+        artist = request.args['artist']
+
+        # hand out a ticket right away if requests are resolved in the background
+        if self.party.intake:
+            try:
+                ticket = self.party.intake.open(listener, track, artist)
+            except IntakeFull as e:
+                logger.warning(str(e))
+                return Response(response=json.dumps({
+                    "ok": False,
+                    "message": str(e)
+                }), status=503)
+            self.spawn(self.resolve(ticket))
+            return Response(response=json.dumps(ticket.to_json()), status=202)
+
+        try:
+            await self.dj.request(listener, track, artist)
+        except SpotifyBusy as e:
+            logger.warning(str(e))
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": str(e)
+            }), status=503)
+        except PartyFoul as e:
+            logger.warning(str(e))
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": str(e)
+            }), status=404)
+
+        # success!
+        logger.info("Request for track {} by guest {} succeeded".format(track, listener))
+        return Response(response=json.dumps({
+            "ok": True,
+            "message": "Added request"
+        }), status=200)
+
+    async def resolve(self, ticket):
+        try:
+            await self.dj.request(ticket.guest_key, ticket.title, ticket.artist)
+        except Exception as e:
+            self.party.intake.close(ticket, e)
+        else:
+            self.party.intake.close(ticket)
+
+    def request_status(self, ticket_id):
+        ticket = self.party.intake.status(ticket_id) if self.party.intake else None
+        if ticket is None:
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": "Unknown ticket {}".format(ticket_id)
+            }), status=404)
+
+        return Response(response=json.dumps(ticket.to_json()), status=200)
+
+    async def queue(self, request):
+        # reads the store when the queue has changed
+        version, body = await blocking(self.party.dj.queue_snapshot.get)
+        etag = '"{}"'.format(version)
+        if_none_match = request.headers.get('if-none-match', '')
+        if if_none_match == '*' or etag in (tag.strip() for tag in if_none_match.split(',')):
+            return Response(status=304, headers={'ETag': etag})
+        return Response(response=body, status=200, headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    def queue_events(self, request):
+        last_event_id = request.headers.get('last-event-id', '')
+        events = self.party.dj.feed.stream_async(int(last_event_id) if last_event_id.isdigit() else None)
+        return Response(response=events, status=200, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    async def process_requests(self, request):
+        batch = await request.get_json()
+        if not isinstance(batch, list) or not all(valid_request(item) for item in batch):
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": "Expected a JSON array of requests with a listener, a track and optionally an artist, each a non-empty string"
+            }), status=400)
+        if len(batch) > MAX_BATCH:
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": "At most {} requests may be sent at once".format(MAX_BATCH)
+            }), status=413)
+
+        results = await self.dj.request_batch([(item['listener'], item['track'], item.get('artist')) for item in batch])
+
+        response = []
+        for item, foul in zip(batch, results):
+            if foul is not None:
+                logger.warning(str(foul))
+                response.append({"ok": False, "message": str(foul)})
+            else:
+                logger.info("Request for track {} by guest {} succeeded".format(item['track'], item['listener']))
+                response.append({"ok": True, "message": "Added request"})
+        return Response(response=json.dumps({
+            "ok": True,
+            "results": response
+        }), status=200)
+
+
+app = App()
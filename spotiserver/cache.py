@@ -0,0 +1,113 @@
+#!/usr/bin/env false
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    """
+    Normalize free-form guest input so that trivially different spellings of
+    the same request share a cache entry
+
+    :rtype: str
+    """
+    if not text:
+        return ''
+    return ' '.join(text.lower().split())
+
+
+class SearchCache:
+    """
+    Bounded LRU cache of Spotify search results with a time to live. Searches
+    that found nothing are cached too (as `None`), with a shorter time to live.
+    """
+
+    def __init__(self, size=1024, ttl=600, negative_ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiration, value), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(title, artist=None):
+        return normalize(title), normalize(artist)
+
+    def get(self, key):
+        """
+        Look up a cached search result
+
+        :return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expiration, value = entry
+                if expiration > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "{} entries, {} hits, {} misses".format(len(self), self.hits, self.misses)
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one call whose result
+    (or exception) is shared by every caller that arrived while it was in
+    flight
+    """
+
+    def __init__(self):
+        self.shared = 0
+        # key -> Future of the call in flight
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                leader = False
+            else:
+                future = self._calls[key] = concurrent.futures.Future()
+                leader = True
+
+        # wait for the caller that got here first
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,223 @@
+#!/usr/bin/env false
+import collections
+import re
+import sys
+import threading
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def words(text):
+    """
+    The words of the text, ignoring case and punctuation, so that
+    "Mr. Brightside" and "mr brightside" look the same
+
+    :rtype: str
+    """
+    if not text:
+        return ''
+    return ' '.join(_PUNCTUATION.sub('', text.lower()).split())
+
+
+def trigrams(text):
+    """
+    Trigrams of each word in the text, ignoring case and punctuation. They
+    are interned, so the catalog's many copies of common trigrams are one
+    string each.
+
+    :rtype: set
+    """
+    grams = set()
+    for word in words(text).split():
+        padded = ' {} '.format(word)
+        grams.update(sys.intern(padded[i:i + 3]) for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a, b):
+    """
+    Dice coefficient of two sets of trigrams
+
+    :rtype: float
+    """
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def containment(a, b):
+    """
+    Fraction of the trigrams in `a` that are also in `b`
+
+    :rtype: float
+    """
+    if not a:
+        return 0.0
+    return len(a & b) / len(a)
+
+
+class TrackCatalog:
+    """
+    Every track the party has seen from Spotify, in search results,
+    recommendations and the party playlist, indexed by the trigrams of its
+    title and artists. Resolves a guest's request locally when a track is a
+    close enough match, so only requests for tracks the party has never seen
+    go to Spotify.
+
+    A request only resolves locally when it matches one song: if tracks by
+    different artists, or with different titles, match it as well, it is
+    left to Spotify. Short titles are only matched loosely when the request
+    names an artist, since "Love" is nearly as similar to "Love Me" as to
+    itself.
+
+    The catalog holds at most `size` tracks, forgetting the least recently
+    seen first.
+    """
+
+    # how similar the request must be to the track's title (and artists)
+    THRESHOLD = 0.75
+    # trigrams a request without an artist needs to be matched loosely
+    LOOSE_MIN = 10
+    # trigrams shared by more tracks than this say little about a request and
+    # are not used to find candidates
+    COMMON = 1000
+    # how many of the likeliest tracks are scored against a request
+    CANDIDATES = 20
+
+    def __init__(self, size=20000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # track id -> (TrackInfo, title trigrams, artist trigrams, order added),
+        # least recently seen first
+        self._tracks = collections.OrderedDict()
+        self._added = 0
+        # trigram -> ids of the tracks whose title or artists contain it
+        self._index = collections.defaultdict(set)
+        # title words -> ids of the tracks with exactly that title
+        self._titles = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def add(self, info):
+        """
+        :param info: the track's TrackInfo; the catalog keeps only that, not
+        the JSON Spotify sent with it
+        """
+        if info.name is None:
+            return
+        track_id = info.track_id
+        with self._lock:
+            if track_id in self._tracks:
+                self._tracks.move_to_end(track_id)
+                return
+            title = trigrams(info.name)
+            artist = trigrams(info.artists)
+            self._added += 1
+            self._tracks[track_id] = (info, title, artist, self._added)
+            for gram in title | artist:
+                self._index[gram].add(track_id)
+            self._titles[words(info.name)].add(track_id)
+            while len(self._tracks) > self.size:
+                self._forget(*self._tracks.popitem(last=False))
+
+    def add_all(self, tracks):
+        for info in tracks:
+            self.add(info)
+
+    def _forget(self, track_id, entry):
+        info, title, artist, added = entry
+        for gram in title | artist:
+            ids = self._index[gram]
+            ids.discard(track_id)
+            if not ids:
+                del self._index[gram]
+        name = words(info.name)
+        self._titles[name].discard(track_id)
+        if not self._titles[name]:
+            del self._titles[name]
+
+    def find(self, title, artist=None):
+        """
+        Find the track that matches a request. Without an artist, the title
+        may include the artist's name too.
+
+        :return: the track's TrackInfo, or None if no track, or more than
+        one song, matches well enough
+        :rtype: TrackInfo
+        """
+        title_grams = trigrams(title)
+        artist_grams = trigrams(artist)
+        if not title_grams:
+            return None
+
+        with self._lock:
+            matches = self._find_title(words(title), artist_grams)
+            if not matches and (artist_grams or len(title_grams) >= self.LOOSE_MIN):
+                matches = self._find_similar(title_grams, artist_grams)
+            best = self._only_song(matches)
+
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tracks.move_to_end(best.track_id)
+            return best
+
+    def _only_song(self, matches):
+        """
+        :param matches: catalog entries that match a request
+        :return: the TrackInfo of the first of them to be added, if they are
+        all the same song (the same title by the same artists), or None
+        """
+        if not matches:
+            return None
+        songs = {(words(info.name), words(info.artists)) for info, title, artist, added in matches}
+        if len(songs) > 1:
+            return None
+        return min(matches, key=lambda entry: entry[3])[0]
+
+    def _find_title(self, title, artist_grams):
+        # most requests spell the title right, give or take case and
+        # punctuation
+        matches = []
+        for track_id in self._titles.get(title, ()):
+            entry = self._tracks[track_id]
+            if not artist_grams or containment(artist_grams, entry[2]) >= self.THRESHOLD:
+                matches.append(entry)
+        return matches
+
+    def _find_similar(self, title_grams, artist_grams):
+        # a good match shares at least half of the request's trigrams, so
+        # it must contain one of the rarest len - half + 1 of them; the
+        # tracks that contain the most of those are scored
+        query = title_grams | artist_grams
+        postings = sorted((self._index.get(gram, ()) for gram in query), key=len)
+        shared = collections.Counter()
+        for ids in postings[:len(query) - (len(query) + 1) // 2 + 1]:
+            if len(ids) > self.COMMON:
+                break
+            shared.update(ids)
+
+        # the same candidates in every process, whatever order the sets are in
+        candidates = sorted(shared.items(), key=lambda item: (-item[1], self._tracks[item[0]][3]))
+
+        matches = []
+        for track_id, count in candidates[:self.CANDIDATES]:
+            entry = self._tracks[track_id]
+            info, track_title, track_artist, added = entry
+            if artist_grams:
+                # the guest may name only one of the track's artists
+                if containment(artist_grams, track_artist) < self.THRESHOLD:
+                    continue
+                score = similarity(title_grams, track_title)
+            else:
+                score = max(similarity(title_grams, track_title), similarity(title_grams, track_title | track_artist))
+            if score >= self.THRESHOLD:
+                matches.append(entry)
+        return matches
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def __str__(self):
+        return "{} tracks, {} hits, {} misses".format(len(self), self.hits, self.misses)
@@ -0,0 +1,332 @@
+#!/usr/bin/env false
+import asyncio
+import datetime
+import json
+import logging
+import threading
+import time
+import requests
+import requests.adapters
+import spotipy
+from . import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+# path segments that are followed by an ID, e.g. users/{id}/playlists/{id}
+ID_COLLECTIONS = ('users', 'playlists', 'tracks', 'albums', 'artists', 'audio-features', 'audio-analysis')
+
+
+def endpoint_name(url, prefix):
+    """
+    Name the API endpoint of a URL, leaving out IDs and query parameters so
+    that calls to the same endpoint share a name
+
+    :rtype: str
+    """
+    path = url.split('?')[0]
+    if path.startswith(prefix):
+        path = path[len(prefix):]
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ID_COLLECTIONS:
+            parts[i] = '{id}'
+    return '/'.join(parts)
+
+
+class RateLimited(Exception):
+    """
+    Raised instead of making a call that would have to wait too long for
+    Spotify's rate limit
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Spotify is rate limiting requests; retry in {:.0f} seconds".format(retry_after))
+        self.retry_after = retry_after
+
+
+class CallScheduler:
+    """
+    Token bucket in front of every call to Spotify. Calls that keep music
+    playing go first: a call may only take a token when no call of a higher
+    priority is waiting, and guest searches may not dip into the last
+    `reserve` tokens. A search that would wait longer than `search_wait`
+    seconds is shed instead. After a 429, every call waits out Retry-After.
+
+    :param rate: tokens added per second
+    :param burst: most tokens the bucket holds
+    """
+
+    PLAYBACK = 0
+    BACKGROUND = 1
+    SEARCH = 2
+    # seconds between checks by a coroutine waiting behind higher priorities
+    POLL = 0.05
+
+    def __init__(self, rate=10, burst=20, reserve=5, search_wait=2):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = min(reserve, burst - 1)
+        self.search_wait = search_wait
+        self._tokens = burst
+        self._updated = time.monotonic()
+        # no calls until this time, set by a 429
+        self._blocked_until = 0
+        # number of callers waiting at each priority
+        self._waiting = [0, 0, 0]
+        self._cond = threading.Condition()
+
+    @classmethod
+    def priority(cls, method, endpoint):
+        if endpoint == 'search':
+            return cls.SEARCH
+        if endpoint.startswith('me/player') or (method == 'POST' and endpoint.endswith('/tracks')):
+            return cls.PLAYBACK
+        return cls.BACKGROUND
+
+    def _deadline(self, priority):
+        return time.monotonic() + self.search_wait if priority == self.SEARCH else None
+
+    def _take(self, priority, deadline):
+        """
+        Take a token if one is free for the priority. Called with the lock
+        held, by a caller counted in `_waiting`.
+
+        :return: 0 once a token is taken; otherwise seconds to wait before
+        trying again, or None to wait for the callers ahead to go first
+        :raises RateLimited: if a search would wait past its deadline
+        """
+        now = time.monotonic()
+        floor = 1 + (self.reserve if priority == self.SEARCH else 0)
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        ahead = any(self._waiting[:priority])
+        if not ahead and now >= self._blocked_until and self._tokens >= floor:
+            self._tokens -= 1
+            return 0
+
+        # without anyone ahead, we know when a token will be free
+        wait = None
+        if not ahead:
+            wait = max(self._blocked_until - now, (floor - self._tokens) / self.rate)
+        if deadline is not None:
+            if wait is not None and now + wait > deadline or now >= deadline:
+                raise RateLimited(max(self._blocked_until - now, 1))
+            wait = min(wait, deadline - now) if wait is not None else deadline - now
+        return wait
+
+    def acquire(self, priority):
+        """
+        Wait for a token
+
+        :raises RateLimited: if a search would wait longer than `search_wait`
+        """
+        deadline = self._deadline(priority)
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    wait = self._take(priority, deadline)
+                    if wait == 0:
+                        return
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    async def acquire_async(self, priority):
+        """
+        Like `acquire`, for coroutines
+        """
+        deadline = self._deadline(priority)
+        with self._cond:
+            self._waiting[priority] += 1
+        try:
+            while True:
+                with self._cond:
+                    wait = self._take(priority, deadline)
+                    if wait and any(self._waiting[:priority]):
+                        # nothing wakes a coroutine when the callers ahead
+                        # are done, so check again soon
+                        wait = min(wait, self.POLL)
+                if wait == 0:
+                    return
+                await asyncio.sleep(wait if wait is not None else self.POLL)
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def retry_delay(self, priority, method, error, attempt, retries):
+        """
+        Decide whether to retry a call that failed with a SpotifyException
+
+        :return: seconds to sleep before acquiring a token for the retry
+        :raises: RateLimited for a search that got a 429, or the error itself
+        if the call should not be retried
+        """
+        if error.http_status == 429:
+            try:
+                retry_after = int(error.headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1
+            self.backoff(retry_after)
+            if priority == self.SEARCH:
+                raise RateLimited(retry_after)
+            delay = 0
+        elif method == 'GET' and 500 <= error.http_status < 600:
+            delay = attempt
+        else:
+            raise error
+        if attempt > retries:
+            raise error
+        return delay
+
+    def backoff(self, seconds):
+        """
+        Hold every call for `seconds`, as asked by a 429 response
+        """
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+        logger.warning("Spotify is rate limiting requests; holding calls for {} seconds.".format(seconds))
+
+
+class PooledSpotify(spotipy.client.Spotify):
+    """
+    Long-lived Spotify client whose HTTP connections are kept alive in a pool
+    between calls, and whose access token can be swapped in place. Calls are
+    paced by `scheduler`, which also takes over spotipy's retries.
+    """
+
+    # retries for a call that got a 429 or, for GETs, a server error
+    RETRIES = 3
+
+    def __init__(self, pool_size=10, scheduler=None, **kwargs):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        super().__init__(requests_session=session, **kwargs)
+        self.scheduler = scheduler or CallScheduler()
+
+    def set_auth(self, token):
+        self._auth = token
+
+    def _get(self, url, args=None, payload=None, **kwargs):
+        if args:
+            kwargs.update(args)
+        return self._internal_call('GET', url, payload, kwargs)
+
+    def _internal_call(self, method, url, payload, params):
+        endpoint = endpoint_name(url, self.prefix)
+        priority = self.scheduler.priority(method, endpoint)
+        attempt = 0
+        with tracing.span('spotify', method=method, endpoint=endpoint) as span:
+            while True:
+                with tracing.span('scheduler'):
+                    self.scheduler.acquire(priority)
+                try:
+                    return self._timed_call(method, endpoint, url, payload, params)
+                except spotipy.client.SpotifyException as e:
+                    attempt += 1
+                    span.set('attempts', attempt + 1)
+                    delay = self.scheduler.retry_delay(priority, method, e, attempt, self.RETRIES)
+                    if delay:
+                        time.sleep(delay)
+
+    def _timed_call(self, method, endpoint, url, payload, params):
+        started = time.time()
+        status = 'ok'
+        try:
+            return self._call(method, url, payload, params)
+        except spotipy.client.SpotifyException as e:
+            status = str(e.http_status)
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            metrics.SPOTIFY_LATENCY.observe(time.time() - started, method, endpoint, status)
+
+    def _call(self, method, url, payload, params):
+        # spotipy closes the connection after every call, which throws away
+        # the pool; this is the same call without that
+        args = dict(params=params, timeout=self.requests_timeout)
+        if not url.startswith('http'):
+            url = self.prefix + url
+        headers = self._auth_headers()
+        headers['Content-Type'] = 'application/json'
+        if payload:
+            args['data'] = json.dumps(payload)
+
+        r = self._session.request(method, url, headers=headers, proxies=self.proxies, **args)
+
+        if r.status_code >= 400:
+            message = 'error'
+            if r.text and r.text != 'null':
+                try:
+                    message = r.json()['error']['message']
+                except (ValueError, KeyError, TypeError):
+                    pass
+            raise spotipy.client.SpotifyException(r.status_code, -1, '{}:\n {}'.format(r.url, message), headers=r.headers)
+
+        if r.text and r.text != 'null':
+            return r.json()
+        return None
+
+
+class TokenRefresher:
+    """
+    Keeps a client's OAuth token fresh from a background thread, renewing it
+    `MARGIN` seconds before it expires
+    """
+
+    MARGIN = 300
+    # how long to wait before checking again for a token when there is none
+    RETRY = 10
+
+    def __init__(self, sp_oauth, client):
+        self.sp_oauth = sp_oauth
+        self.client = client
+        self.expires_at = 0
+        # set once the client has a usable token
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.run, name='token-refresher', daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                delay = self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the Spotify access token; retrying in {} seconds.".format(self.RETRY))
+                delay = self.RETRY
+            time.sleep(delay)
+
+    def refresh(self):
+        """
+        Load the cached token, renewing it if it is about to expire, and hand
+        it to the client
+
+        :return: seconds until the token should be refreshed again
+        """
+        with tracing.trace('token_refresh'), self._lock:
+            token_json = self.sp_oauth.get_cached_token()
+            if not token_json:
+                logger.error("DJ does not have a valid Spotify OAuth token!")
+                return self.RETRY
+
+            if token_json['expires_at'] - time.time() < self.MARGIN:
+                with tracing.span('renew'):
+                    token_json = self.sp_oauth.refresh_access_token(token_json['refresh_token'])
+                if not token_json:
+                    return self.RETRY
+
+            if token_json['expires_at'] != self.expires_at:
+                logger.info("Access token expires at {} UTC.".format(datetime.datetime.utcfromtimestamp(token_json['expires_at']).isoformat()))
+            self.expires_at = token_json['expires_at']
+            self.client.set_auth(token_json['access_token'])
+            self.ready.set()
+            return max(self.expires_at - self.MARGIN - time.time(), 1)
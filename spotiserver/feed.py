@@ -0,0 +1,185 @@
+#!/usr/bin/env false
+import asyncio
+import collections
+import itertools
+import json
+import threading
+
+
+def format_event(seq, event, data):
+    """
+    :param data: the event's JSON, serialized or not
+    :return: the event in the Server-Sent Events wire format
+    :rtype: str
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data, separators=(',', ':'))
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(seq, event, data)
+
+
+class Snapshot:
+    """
+    Serialized JSON of some state, rebuilt by `build` only when `version`
+    says the state has changed
+    """
+
+    def __init__(self, version, build):
+        self.version = version
+        self.build = build
+        self.builds = 0
+        # (version, JSON text)
+        self._cached = (None, None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        :return: the state's version and its JSON
+        """
+        version = self.version()
+        cached = self._cached
+        if cached[0] == version:
+            return cached
+        with self._lock:
+            # another thread may have rebuilt it while we waited
+            if self._cached[0] == version:
+                return self._cached
+            # a change made during the build is only reflected in the text,
+            # and the next version rebuilds it anyway
+            self._cached = (version, json.dumps(self.build(), separators=(',', ':')))
+            self.builds += 1
+            return self._cached
+
+
+class QueueFeed:
+    """
+    Fan-out of changes to the party queue to any number of viewers, as
+    Server-Sent Events. Each change is serialized once into a buffer of
+    recent events that every viewer reads from. Events carry absolute values
+    (a track's vote total, not just the new vote), so a viewer can apply them
+    on top of any snapshot taken before them.
+
+    A viewer starts with the queue's JSON from `snapshot`, which is
+    shared by every viewer that connects before the queue changes again. A
+    viewer that reconnects with the id of the last event it saw only gets the
+    events it missed, unless they have already left the buffer.
+    """
+
+    # events kept for viewers that are catching up
+    SIZE = 1000
+    # seconds between comments sent to keep idle connections open
+    KEEPALIVE = 15
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.seq = 0
+        self.viewers = 0
+        # (seq, event text), oldest first
+        self._events = collections.deque(maxlen=self.SIZE)
+        # (seq, event text) of the last snapshot handed out
+        self._snapshot = (None, None)
+        self._cond = threading.Condition()
+        # event loop with viewers streaming from it, and the event that wakes
+        # them on the next publish
+        self._loop = None
+        self._changed = None
+
+    def publish(self, event, data):
+        with self._cond:
+            self.seq += 1
+            text = format_event(self.seq, event, data)
+            self._events.append((self.seq, text))
+            self._cond.notify_all()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._wake_loop)
+
+    def snapshot_event(self):
+        """
+        :return: the seq the snapshot is current to, and the snapshot event
+        """
+        with self._cond:
+            seq = self.seq
+            if self._snapshot[0] == seq:
+                return self._snapshot
+        # taken outside the lock, since publishers call us while holding the
+        # store's lock; events published meanwhile are sent again after it,
+        # which is harmless
+        snapshot = (seq, format_event(seq, 'snapshot', self.snapshot()))
+        with self._cond:
+            self._snapshot = snapshot
+        return snapshot
+
+    def _since(self, seq):
+        """
+        :return: the events after seq, or None if some of them are no longer
+        buffered. Called with the lock held.
+        """
+        if seq == self.seq:
+            return []
+        if not self._events or seq < self._events[0][0] - 1 or seq > self.seq:
+            return None
+        return [text for _, text in itertools.islice(self._events, seq - self._events[0][0] + 1, None)]
+
+    def _next(self, last_seq):
+        """
+        :return: the seq the viewer is now up to, and the text to send it
+        """
+        with self._cond:
+            pending = self._since(last_seq) if last_seq is not None else None
+            if pending is not None:
+                return self.seq, ''.join(pending) if pending else None
+        # new, or fell too far behind to catch up event by event
+        return self.snapshot_event()
+
+    def stream(self, last_seq=None):
+        """
+        Generate the events for one viewer, forever
+        """
+        with self._cond:
+            self.viewers += 1
+        try:
+            last_seq, text = self._next(last_seq)
+            if text:
+                yield text
+            while True:
+                with self._cond:
+                    if self.seq == last_seq:
+                        self._cond.wait(self.KEEPALIVE)
+                last_seq, text = self._next(last_seq)
+                yield text or ': keepalive\n\n'
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    async def stream_async(self, last_seq=None):
+        """
+        Like `stream`, for an event loop. Publishing wakes every viewer on
+        the loop through one shared asyncio.Event.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self.viewers += 1
+            if self._loop is not loop:
+                self._loop, self._changed = loop, asyncio.Event()
+        try:
+            # a snapshot reads the party's store, which may block
+            last_seq, text = await loop.run_in_executor(None, self._next, last_seq)
+            if text:
+                yield text
+            while True:
+                # taken before checking for events, so a publish after the
+                # check still wakes us
+                changed = self._changed
+                if self.seq == last_seq:
+                    try:
+                        await asyncio.wait_for(changed.wait(), self.KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        pass
+                last_seq, text = await loop.run_in_executor(None, self._next, last_seq)
+                yield text or ': keepalive\n\n'
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    def _wake_loop(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
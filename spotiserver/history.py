@@ -0,0 +1,77 @@
+#!/usr/bin/env false
+import collections
+import threading
+import time
+
+
+class PlayedHistory:
+    """
+    The last `size` tracks added to the party playlist, so the DJ can tell in
+    O(1) whether a track has played, or is lined up to play, recently. A ring
+    buffer holds the tracks in the order they were added, and a count of each
+    track in it answers lookups.
+
+    With a `store`, the history is shared with every DJ serving the party:
+    tracks are added to the store, and each DJ's copy catches up with it at
+    most every `REFRESH` seconds, so followers turn away repeats the leader
+    has played too.
+    """
+
+    # seconds between catching up with tracks added by other DJs
+    REFRESH = 1.0
+
+    def __init__(self, size=200, store=None):
+        self.size = size
+        self.store = store
+        self._order = collections.deque()
+        # track id -> times it is in `_order`
+        self._counts = {}
+        # the store's sequence number of the last track in `_order`
+        self._seq = 0
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, track_id):
+        self.add_all([track_id])
+
+    def add_all(self, track_ids):
+        if self.store is None:
+            with self._lock:
+                for track_id in track_ids:
+                    self._add(track_id)
+            return
+        # the tracks come back from the store with everyone else's, in the
+        # order they were added
+        self.store.add_played(track_ids, self.size)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Catch up with the tracks added to the store since the last refresh
+        """
+        if self.store is None:
+            return
+        with self._lock:
+            self._refreshed = time.time()
+            for seq, track_id in self.store.played_since(self._seq):
+                self._add(track_id)
+                self._seq = seq
+
+    def _add(self, track_id):
+        self._order.append(track_id)
+        self._counts[track_id] = self._counts.get(track_id, 0) + 1
+        while len(self._order) > self.size:
+            oldest = self._order.popleft()
+            count = self._counts[oldest] - 1
+            if count:
+                self._counts[oldest] = count
+            else:
+                del self._counts[oldest]
+
+    def __contains__(self, track_id):
+        if self.store is not None and time.time() - self._refreshed >= self.REFRESH:
+            self.refresh()
+        return track_id in self._counts
+
+    def __len__(self):
+        return len(self._order)
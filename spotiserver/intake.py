@@ -0,0 +1,141 @@
+#!/usr/bin/env false
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+from .party import PartyFoul, ExplicitTrack
+
+logger = logging.getLogger(__name__)
+
+
+class IntakeFull(PartyFoul):
+    """
+    Too many requests are waiting to be resolved to take another one
+    """
+    pass
+
+
+class Ticket:
+    """
+    Receipt handed to a guest whose request is resolved in the background
+    """
+    __slots__ = ('ticket_id', 'guest_key', 'title', 'artist', 'status', 'message', 'time_created')
+
+    PENDING = 'pending'
+    ACCEPTED = 'accepted'
+    REJECTED = 'rejected'
+    EXPLICIT = 'explicit'
+    ERROR = 'error'
+
+    def __init__(self, guest_key, title, artist):
+        self.ticket_id = uuid.uuid4().hex
+        self.guest_key = guest_key
+        self.title = title
+        self.artist = artist
+        self.status = self.PENDING
+        self.message = "Request received"
+        self.time_created = time.time()
+
+    def to_json(self):
+        return {
+            "ok": self.status in (self.PENDING, self.ACCEPTED),
+            "ticket": self.ticket_id,
+            "status": self.status,
+            "message": self.message,
+        }
+
+
+class Intake:
+    """
+    Accepts guest requests without waiting on Spotify. Each request is handed
+    to a worker pool and the outcome is recorded on its ticket.
+
+    At most `max_pending` requests may be waiting to be resolved; more are
+    turned away with IntakeFull. Of the tickets that have been resolved, the
+    oldest are forgotten once there are more than `max_tickets` tickets, but
+    a pending ticket is kept until it is resolved.
+    """
+
+    def __init__(self, party, workers=4, max_tickets=10000, max_pending=1000):
+        self.party = party
+        self.max_tickets = max_tickets
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='intake')
+        # ticket id -> Ticket, oldest first
+        self._tickets = collections.OrderedDict()
+        self._tickets_lock = threading.Lock()
+
+    def submit(self, guest_key, title, artist=None):
+        """
+        Enqueue a request and return its ticket immediately, or raise
+        IntakeFull if too many requests are waiting already
+
+        :rtype: Ticket
+        """
+        ticket = self.open(guest_key, title, artist)
+        self._pool.submit(self._resolve, ticket)
+        return ticket
+
+    def open(self, guest_key, title, artist=None):
+        """
+        Issue a ticket for a request that the caller will resolve and
+        `close`, or raise IntakeFull if too many requests are waiting already
+
+        :rtype: Ticket
+        """
+        ticket = Ticket(guest_key, title, artist)
+        with self._tickets_lock:
+            if self.pending >= self.max_pending:
+                raise IntakeFull("Too many requests are waiting to be processed; try again shortly")
+            self.pending += 1
+            self._tickets[ticket.ticket_id] = ticket
+            if len(self._tickets) > self.max_tickets:
+                self._forget()
+        return ticket
+
+    def _forget(self):
+        # forget the oldest tickets that have been resolved; pending ones
+        # cannot be forgotten yet, so they go to the back of the line
+        passed = 0
+        while len(self._tickets) > self.max_tickets and passed < len(self._tickets):
+            ticket_id, ticket = next(iter(self._tickets.items()))
+            if ticket.status == Ticket.PENDING:
+                self._tickets.move_to_end(ticket_id)
+                passed += 1
+            else:
+                del self._tickets[ticket_id]
+
+    def status(self, ticket_id):
+        with self._tickets_lock:
+            return self._tickets.get(ticket_id)
+
+    def _resolve(self, ticket):
+        try:
+            self.party.bouncer.request(ticket.guest_key, ticket.title, ticket.artist)
+        except Exception as e:
+            self.close(ticket, e)
+        else:
+            self.close(ticket)
+
+    def close(self, ticket, error=None):
+        """
+        Record the outcome of a ticket's request: None if it was accepted, or
+        the exception it failed with
+        """
+        with self._tickets_lock:
+            self.pending -= 1
+        if error is None:
+            ticket.status, ticket.message = Ticket.ACCEPTED, "Added request"
+            logger.info("Request for track {} by guest {} succeeded".format(ticket.title, ticket.guest_key))
+        elif isinstance(error, ExplicitTrack):
+            ticket.status, ticket.message = Ticket.EXPLICIT, str(error)
+            logger.warning(str(error))
+        elif isinstance(error, PartyFoul):
+            ticket.status, ticket.message = Ticket.REJECTED, str(error)
+            logger.warning(str(error))
+        else:
+            ticket.status, ticket.message = Ticket.ERROR, "Request could not be processed"
+            logger.error("Intake failed to process ticket {}".format(ticket.ticket_id), exc_info=error)
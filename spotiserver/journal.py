@@ -0,0 +1,131 @@
+#!/usr/bin/env false
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Append-only log of every change to an in-memory party, so the party can
+    be rebuilt after a crash. Records are written in batches by a background
+    thread, and the log is periodically compacted into a snapshot of the
+    whole party.
+
+    Each line of the journal is a JSON list: the record's sequence number,
+    followed by the change itself. The snapshot remembers the sequence number
+    it was taken at, so records that it already covers are skipped when
+    replaying.
+    """
+
+    # write at most this many records per batch
+    BATCH_SIZE = 1000
+    # take a snapshot after this many records
+    COMPACT_EVERY = 50000
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.seq = 0
+        self._snapshot_seq = 0
+        self._pending = queue.Queue()
+        self._file = None
+
+    def append(self, record):
+        """
+        Queue a record to be written. Called with the store's lock held, so
+        sequence numbers follow the order of the changes.
+        """
+        self.seq += 1
+        self._pending.put((self.seq,) + tuple(record))
+
+    def recover(self, store):
+        """
+        Rebuild the store from the snapshot and the records written after it
+        """
+        started = time.time()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self._snapshot_seq = self.seq = snapshot['seq']
+            store.load(snapshot['state'])
+
+        replayed = 0
+        if os.path.exists(self.path):
+            # the end of the last complete record
+            good = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if record[0] <= self.seq:
+                        continue
+                    store.replay(record[1:])
+                    self.seq = record[0]
+                    replayed += 1
+            # the last line may be cut short by a crash; cut it off, so new
+            # records are not appended to it
+            if good < os.path.getsize(self.path):
+                logger.warning("Discarding a torn record at byte {} of the party journal.".format(good))
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good)
+
+        logger.info("Recovered party state up to record {} ({} records replayed) in {:.3f} seconds.".format(self.seq, replayed, time.time() - started))
+
+    def start(self, store):
+        self._file = open(self.path, 'a')
+        threading.Thread(target=self.run, args=(store,), name='journal', daemon=True).start()
+
+    def run(self, store):
+        while True:
+            try:
+                self.write(self._pending.get())
+                if self.seq - self._snapshot_seq >= self.COMPACT_EVERY:
+                    self.compact(store)
+            except Exception:
+                logger.exception("Failed to write the party journal.")
+                time.sleep(1)
+
+    def write(self, first):
+        batch = [first]
+        while len(batch) < self.BATCH_SIZE:
+            try:
+                batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        # records queued before the last snapshot are already part of it
+        self._file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                                 for record in batch if record[0] > self._snapshot_seq))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def compact(self, store):
+        """
+        Write a snapshot of the store and start a fresh journal
+        """
+        with store.transaction():
+            state = store.dump()
+            seq = self.seq
+
+        # everything in the journal file was appended before the snapshot
+        # was taken, so the snapshot makes all of it redundant
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'seq': seq, 'state': state}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_seq = seq
+
+        self._file.close()
+        self._file = open(self.path, 'w')
+        logger.info("Compacted the party journal into a snapshot at record {}.".format(seq))
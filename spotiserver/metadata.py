@@ -0,0 +1,96 @@
+#!/usr/bin/env false
+import collections
+import threading
+
+
+class TrackInfo:
+    """
+    What the party needs to know about a track, without the rest of the
+    JSON that Spotify sent with it
+    """
+    __slots__ = ('track_id', 'name', 'artists', 'uri', 'explicit', 'duration')
+
+    def __init__(self, track_id, name, artists, uri, explicit, duration):
+        self.track_id = track_id
+        self.name = name
+        self.artists = artists
+        self.uri = uri
+        self.explicit = explicit
+        # seconds
+        self.duration = duration
+
+    @classmethod
+    def from_json(cls, track_json):
+        return cls(
+            track_json['id'],
+            track_json.get('name'),
+            ', '.join(artist['name'] for artist in track_json.get('artists', ())),
+            track_json.get('uri'),
+            bool(track_json.get('explicit')),
+            track_json['duration_ms'] / 1000 if track_json.get('duration_ms') else None
+        )
+
+    def to_json(self):
+        return {
+            "id": self.track_id,
+            "name": self.name,
+            "artists": self.artists,
+            "uri": self.uri,
+            "explicit": self.explicit,
+            "duration": self.duration,
+        }
+
+    def __str__(self):
+        if self.artists:
+            return "'{}' by {} ({})".format(self.name, self.artists, self.uri)
+        return "'{}' ({})".format(self.name, self.uri)
+
+
+class TrackMetadata:
+    """
+    TrackInfo for every track seen in a response from Spotify, keyed by track
+    id. Holds at most `size` tracks, forgetting the least recently seen first.
+    """
+
+    def __init__(self, size=50000):
+        self.size = size
+        self._tracks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, info):
+        with self._lock:
+            self._tracks[info.track_id] = info
+            self._tracks.move_to_end(info.track_id)
+            while len(self._tracks) > self.size:
+                self._tracks.popitem(last=False)
+
+    def add_all(self, tracks):
+        for info in tracks:
+            self.add(info)
+
+    def get(self, track_id):
+        """
+        :rtype: TrackInfo
+        """
+        return self._tracks.get(track_id)
+
+    def duration(self, track_id):
+        """
+        :return: the track's length in seconds, or None if it is not known
+        """
+        info = self._tracks.get(track_id)
+        return info.duration if info else None
+
+    def describe(self, track_id):
+        """
+        :return: the track's name and artists if they are known, for logging
+        :rtype: str
+        """
+        info = self._tracks.get(track_id)
+        return str(info) if info else track_id
+
+    def __contains__(self, track_id):
+        return track_id in self._tracks
+
+    def __len__(self):
+        return len(self._tracks)
@@ -0,0 +1,143 @@
+#!/usr/bin/env false
+"""
+Minimal metrics in the Prometheus text exposition format
+"""
+import bisect
+import threading
+
+# every metric created in this module, in the order it is rendered
+REGISTRY = []
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _labels(self.label_names, labels), _number(value)) for labels, value in values]
+
+
+class Gauge(Metric):
+    """
+    Gauge whose value is read from a function when the metrics are rendered
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return []
+        return ['{} {}'.format(self.name, _number(self.function()))]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    # seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, _labels(self.label_names, labels, [('le', _number(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(self.label_names, labels), _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, _labels(self.label_names, labels), cumulative))
+        return lines
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+SPOTIFY_LATENCY = Histogram(
+    'spotiserver_spotify_request_seconds',
+    "Time taken by calls to the Spotify Web API.",
+    labels=('method', 'endpoint', 'status'))
+REQUESTS = Counter(
+    'spotiserver_requests_total',
+    "Guest requests by outcome.",
+    labels=('outcome',))
+QUEUE_WAIT = Histogram(
+    'spotiserver_queue_wait_seconds',
+    "Time from a track entering the guest queue to starting to play.",
+    buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+QUEUE_DEPTH = Gauge(
+    'spotiserver_queue_depth',
+    "Tracks waiting in the guest queue.")
+TRACKS = Gauge(
+    'spotiserver_tracks',
+    "Tracks that guests have voted for.")
+VIEWERS = Gauge(
+    'spotiserver_queue_viewers',
+    "Clients streaming changes to the queue.")
+GUESTS = Gauge(
+    'spotiserver_guests',
+    "Guests that have had a request accepted.")
@@ -1,33 +1,82 @@
 #!/usr/bin/env false
-import datetime
 import logging
-import spotipy
-import threading
+import math
 import time
 import random
-import heapq
+import uuid
+from . import metrics, tracing
+from .admission import RecentRequests, SlidingWindow
+from .cache import SearchCache, SingleFlight
+from .catalog import TrackCatalog
+from .feed import QueueFeed, Snapshot
+from .history import PlayedHistory
+from .metadata import TrackInfo, TrackMetadata
+from .client import PooledSpotify, RateLimited, TokenRefresher
+from .scheduler import MixSchedule, PlaylistMirror
+from .recommend import RecommendationPool, SeedPlaylist
 
 logger = logging.getLogger(__name__)
 
 class PartyFoul(Exception):
     pass
 
+class ExplicitTrack(PartyFoul):
+    pass
+
+class TrackNotFound(PartyFoul):
+    pass
+
+class SpotifyBusy(PartyFoul):
+    pass
+
+class TooManyRequests(PartyFoul):
+    pass
+
+class AlreadyPlayed(PartyFoul):
+    pass
+
+def add_log2(a, b):
+    """
+    :return: log2(2**a + 2**b), without overflowing
+    :rtype: float
+    """
+    if a < b:
+        a, b = b, a
+    if b == -math.inf:
+        return a
+    return a + math.log2(1 + 2 ** (b - a))
+
 class Track:
+    __slots__ = ('spotify_id', 'requests', 'votes', 'score', '_time_created', '_time_updated', '_time_queued')
 
     def __init__(self, spotify_id):
         self.spotify_id = spotify_id
         self.requests = dict()
+        # running total of the values in `requests`
+        self.votes = 0
+        # log2 of the total weight of the votes; see StateStore.vote_weight
+        self.score = -math.inf
         self._time_created = time.time()
         self._time_updated = time.time()
+        self._time_queued = None
 
-    def vote(self, guest):
-        count = self.requests.get(guest.key, 0)
-        self.requests[guest.key] = count + 1
+    def vote(self, guest_key, weight=0.0):
+        """
+        :param weight: log2 of the vote's weight
+        """
+        count = self.requests.get(guest_key, 0)
+        self.requests[guest_key] = count + 1
+        self.votes += 1
+        self.score = add_log2(self.score, weight)
         self._time_updated = time.time()
 
-    @property
-    def votes(self):
-        return sum(self.requests.values())
+    def reset(self):
+        """
+        Forget all votes for the track once it has been played
+        """
+        self.requests = dict()
+        self.votes = 0
+        self.score = -math.inf
 
     def __str__(self):
         return self.spotify_id
@@ -37,11 +86,100 @@ class Track:
         Because we are using a min-heap queue, the 'smallest' track will be
         played first
         """
-        if self.votes == other.votes:
+        if self.score == other.score:
             return self._time_created > other._time_created
-        return self.votes > other.votes
+        return self.score > other.score
+
+class TrackQueue:
+    """
+    Min-heap of tracks that remembers where each track lives in the heap, so
+    membership checks are O(1) and a track whose votes changed after it was
+    pushed can be re-sifted or removed in O(log n)
+    """
+
+    def __init__(self):
+        self._heap = []
+        # map of spotify id -> position in the heap
+        self._index = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, track):
+        return track.spotify_id in self._index
+
+    def __iter__(self):
+        return iter(list(self._heap))
+
+    def push(self, track):
+        assert track not in self
+        self._heap.append(track)
+        self._index[track.spotify_id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def peek(self):
+        return self._heap[0]
+
+    def pop(self):
+        """
+        Remove and return the track that should be played next
+
+        :rtype: Track
+        """
+        track = self._heap[0]
+        self._remove_at(0)
+        return track
+
+    def remove(self, track):
+        self._remove_at(self._index[track.spotify_id])
+
+    def update(self, track):
+        """
+        Restore the heap order after the given track's votes have changed
+        """
+        pos = self._index[track.spotify_id]
+        self._sift_down(self._sift_up(pos))
+
+    def _remove_at(self, pos):
+        del self._index[self._heap[pos].spotify_id]
+        last = self._heap.pop()
+        if pos < len(self._heap):
+            # move the last track into the hole and restore the heap order
+            self._heap[pos] = last
+            self._index[last.spotify_id] = pos
+            self._sift_down(self._sift_up(pos))
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._index[heap[i].spotify_id] = i
+        self._index[heap[j].spotify_id] = j
+
+    def _sift_up(self, pos):
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not self._heap[pos] < self._heap[parent]:
+                break
+            self._swap(pos, parent)
+            pos = parent
+        return pos
+
+    def _sift_down(self, pos):
+        heap = self._heap
+        while True:
+            child = 2 * pos + 1
+            if child >= len(heap):
+                return pos
+            if child + 1 < len(heap) and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < heap[pos]:
+                return pos
+            self._swap(pos, child)
+            pos = child
+
 
 class TrackRequest:
+    __slots__ = ('guest', 'track')
 
     def __init__(self, guest, track):
         self.guest = guest
@@ -49,65 +187,134 @@ class TrackRequest:
 
 
 class Guest:
+    __slots__ = ('key', 'requests')
 
     def __init__(self, key):
         self.key = key
         self.requests = 0
-        logger.info("New guest created with key {}".format(key))
 
     def __str__(self):
         return self.key
 
 
-# class RefreshingSpotify(spotipy.client.Spotify):
-#     # def __init__(self, *args, **kwargs):
-#         assert isinstance(self.oauth, spotipy.oauth2.SpotifyOAuth)
-#     def _internal_call(self, method, url, payload, params):
-#         try:
-#             return self._internal_call(*args, **kwargs)
-#         except SpotifyException as e:
-#             if e.http_status == 401:
-#                 token_json = self.party.sp_oauth.get_cached_token()
-#                 return self._internal_call(*args, **kwargs)
-#             raise
-
-
 class DJ:
 
-    def __init__(self, party):
+    # seconds a DJ may go without renewing its claim to lead the party
+    LEADER_TTL = 30
+
+    def __init__(self, party, pool_size=10, scheduler=None):
         self.party = party
-        self._sp = None
-        # map of all tracks
-        self.track_map = {}
-        # queue of tracks that are about to play
-        self.track_queue = []
-        self._expiration = 0
+        # one client for the whole party, kept authorized in the background
+        self._sp = PooledSpotify(pool_size=pool_size, scheduler=scheduler)
+        self.token_refresher = TokenRefresher(party.sp_oauth, self._sp)
+        # identifies this DJ when claiming leadership of a shared party
+        self.dj_id = uuid.uuid4().hex
+        # recent search results, keyed by the normalized request
+        self.search_cache = SearchCache()
+        # searches that are waiting on Spotify, shared by identical requests
+        self.searches_in_flight = SingleFlight()
+        # every track seen from Spotify, to resolve requests without searching
+        self.catalog = TrackCatalog()
+        # names, durations and so on of every track seen from Spotify
+        self.tracks = TrackMetadata()
+        # the queue as JSON, for everyone who asks until it changes
+        self.queue_snapshot = Snapshot(self.queue_version, self.queue_state)
+        # changes to the queue, streamed to anyone watching the party
+        self.feed = QueueFeed(lambda: self.queue_snapshot.get()[1])
+        self._announced = None
+        # what is playing and what is lined up behind it
+        self.schedule = MixSchedule()
+        # the end of the party playlist, kept up to date as tracks are added
+        self.mirror = PlaylistMirror()
+        # tracks added to the playlist recently, which are not added again
+        self.history = PlayedHistory(store=party.store)
+        # track id -> when it was queued, for tracks picked from the guest
+        # queue that have not started playing yet
+        self.waiting = {}
+        # recommended tracks to fall back on when guests have not voted
+        self.seed_playlist = SeedPlaylist()
+        self.recommendations = RecommendationPool(self)
 
     @property
     def sp(self):
-        if isinstance(self._sp, spotipy.Spotify) and time.time() + 10 < self._expiration:
-            return self._sp
-        token_json = self.party.sp_oauth.get_cached_token()
-        while not token_json:
-            logger.error("DJ does not have a valid Spotify OAuth token!")
-            token_json = self.party.sp_oauth.get_cached_token()
-            time.sleep(10)
-
-        self._expiration = token_json['expires_at']
-        logger.warn("Access token expires at {} UTC.".format(datetime.datetime.utcfromtimestamp(token_json['expires_at']).isoformat()))
-
-        token = token_json['access_token']
-        self._sp = spotipy.client.Spotify(auth=token)
+        if not self.token_refresher.ready.is_set():
+            raise PartyFoul("The party host has not logged in to Spotify yet.")
         return self._sp
 
+    def remember(self, tracks):
+        """
+        Keep the tracks from a Spotify response in the catalog and the
+        metadata store, as TrackInfo: the rest of their JSON (album art,
+        available markets and so on) is not kept anywhere
+
+        :return: the tracks' TrackInfo
+        :rtype: list
+        """
+        tracks = [TrackInfo.from_json(track_json) for track_json in tracks if track_json and track_json.get('id')]
+        self.catalog.add_all(tracks)
+        self.tracks.add_all(tracks)
+        return tracks
+
+    def track_json(self, track_id, **fields):
+        """
+        :return: what viewers of the queue are shown about a track
+        :rtype: dict
+        """
+        info = self.tracks.get(track_id)
+        track_json = info.to_json() if info else {"id": track_id}
+        track_json.update(fields)
+        return track_json
+
+    def queue_version(self):
+        """
+        :return: a version of `queue_state`, which changes whenever it does
+        :rtype: str
+        """
+        return str(self.party.store.queue_version())
+
+    def queue_state(self):
+        """
+        :return: the track that is playing and the tracks queued by guests
+        :rtype: dict
+        """
+        return {
+            "ok": True,
+            # set by whichever DJ is leading the party
+            "now_playing": self.party.store.now_playing(),
+            "queue": [self.track_json(track_id, votes=votes) for track_id, votes in self.party.store.queued_tracks()],
+        }
+
+    def announce(self):
+        """
+        Tell viewers when a new track starts playing
+        """
+        current = self.schedule.current
+        if current and current != self._announced:
+            self._announced = current
+            self.party.store.set_playing(self.track_json(current))
+            self.feed.publish('now_playing', self.track_json(current, remaining=round(self.schedule.time_left())))
+            queued_at = self.waiting.pop(current, None)
+            if queued_at is not None:
+                metrics.QUEUE_WAIT.observe(time.time() - queued_at)
+            # forget tracks that were skipped or taken off the playlist
+            for track_id in [track_id for track_id in self.waiting if track_id not in self.schedule.upcoming]:
+                del self.waiting[track_id]
+
     def remaining_playback(self):
         """
         Check how much time is remaining until the current track is done
 
         :return: seconds left in track, track id
         """
-        playback = self.sp._get("me/player")
+        return self.check_playback(self.sp._get("me/player"))
 
+    def check_playback(self, playback):
+        """
+        Check that the party host is playing the party playlist
+
+        :param playback: Spotify's me/player JSON
+        :return: seconds left in track, track id
+        """
         if not playback:
             logger.error("Attempt to retrieve playback information from Spotify failed. This usually means that nothing is being played.")
             raise Exception
@@ -129,156 +336,315 @@ class DJ:
         # playback is correct
         logger.info("The party host is playing the correct playlist. All is well.")
 
+        self.remember([playback['item']])
+
         # calculate the remaining ms in the track
         remaining_ms = playback['item']['duration_ms'] - playback['progress_ms']
-        logger.info("{}s left in current track".format(remaining_ms / 1000))
+        logger.info("{}s left in {}".format(remaining_ms / 1000, self.tracks.describe(playback['item']['id'])))
         return remaining_ms / 1000, playback['item']['id']
 
-    def last_tracks(self, playlist_id, num=10):
+    def last_tracks(self, num=10, current=None):
         """
-        Get the Spotify IDs of the last `num` tracks of the given playlist
+        Get the Spotify IDs of the last `num` tracks of the party playlist.
+        They come from the mirror of the playlist, unless its snapshot_id has
+        changed or the mirror does not have the `current` track.
 
-        :rtype: str
+        :rtype: list
         """
         assert num > 0
-        tracks = self.sp.user_playlist_tracks(self.username, playlist_id=playlist_id, limit=num, offset=0)
-        total = tracks["total"]
-        if total > num:
-            tracks = self.sp.user_playlist_tracks(self.username, playlist_id=playlist_id, limit=num, offset=max(0, total-num))
-        return list(map(lambda t: t["track"]["id"], tracks["items"]))
+        playlist_data = self.sp.user_playlist(self.username, self.playlist, fields=self.mirror.FIELDS)
+        if not self.mirror.current(playlist_data, current):
+            tracks = self.sp.user_playlist_tracks(self.username, playlist_id=self.playlist, limit=self.mirror.size,
+                                                  offset=self.mirror.offset(playlist_data))
+            self.load_mirror(playlist_data, tracks)
+        return self.mirror.tail(num)
+
+    def load_mirror(self, playlist_data, tracks):
+        self.remember(t["track"] for t in tracks["items"])
+        self.mirror.load(playlist_data, [t["track"]["id"] for t in tracks["items"] if t["track"]])
+        logger.info("Read the last {} tracks of the party playlist.".format(len(tracks["items"])))
 
     def recommend_tracks(self):
         """
         Ask Spotify to recommend tracks based on a random sampling of tracks
         from a pre-selected playlist
 
+        :return: the recommended tracks' TrackInfo
         :rtype: list
         """
-        # select 5 random tracks from the given playlist to seed Spotify's
+        # select 5 random tracks from the seed playlist to seed Spotify's
         # track generator
-        playlist_data = self.sp.user_playlist(user=self.username, playlist_id=self.playlist)
-        track_list_dict = playlist_data['tracks']['items']
-        track_list = []
-        for i in range(0, 5):
-            track_index = random.randint(0, len(track_list_dict) - 1)
-            track_list.append(track_list_dict[track_index]['track']['id'])
+        seed_ids = self.seed_playlist.load(self.sp)
+        track_list = [random.choice(seed_ids) for i in range(0, 5)]
 
         # retrieve recommendations from Spotify
         recommendation_json = self.sp.recommendations(seed_tracks=track_list)
         recommendation_list = recommendation_json['tracks']
         assert isinstance(recommendation_list, list)
-        return recommendation_list
+        return self.remember(recommendation_list)
 
     def recommend_track(self):
         """
-        Returns a dictionary representing the JSON returned by the Spotify API
-
-        :rtype: dict
+        :rtype: TrackInfo
         """
-        track_list = self.recommend_tracks()
-        # filter out explicit tracks
-        if self.block_explicit:
-            track_list = list(filter(lambda t: not t['explicit'], track_list))
-        # pick a random recommended track
-        return random.choice(track_list)
+        return self.recommendations.pop()
 
     def pick_track_id(self):
-        # if the request queue is not empty, pick the song with the most votes
-        if self.track_queue:
-            track = heapq.heappop(self.track_queue)
-            track.requests = dict()
-            logger.info('Added track to playlist: {} from party guests'.format(track))
-            # TODO reset track votes to zero, update voters, and total votes
-            return track.spotify_id
+        track_id = self.pick_requested_track()
+        if track_id:
+            return track_id
 
         # if the request queue was empty, pick a song from the recommendations
         # list seeded by our already played songs
-        track_json = self.recommend_track()
-        logger.info("Added track to playlist: {} from Spotify recommendations".format(track_json['name']))
-        return track_json['id']
+        return self.pick_recommended_track(self.recommend_track())
+
+    def pick_requested_track(self):
+        """
+        :return: the id of the queued track with the most votes, or None if
+        the queue is empty
+        """
+        with tracing.span('pop_track'):
+            track_id, queued_at = self.party.store.pop_track()
+            # votes may have been counted elsewhere for a track that has
+            # since been played
+            while track_id and track_id in self.history:
+                logger.info("Skipping {}, which was played recently".format(self.tracks.describe(track_id)))
+                track_id, queued_at = self.party.store.pop_track()
+        if track_id:
+            if queued_at is not None:
+                self.waiting[track_id] = queued_at
+            logger.info('Added track to playlist: {} from party guests'.format(self.tracks.describe(track_id)))
+            # TODO update voters and total votes
+            self.feed.publish('pick', {"id": track_id, "source": "guests"})
+        return track_id
+
+    def pick_recommended_track(self, info):
+        logger.info("Added track to playlist: {} from Spotify recommendations".format(info))
+        self.feed.publish('pick', {"id": info.track_id, "source": "recommendations"})
+        return info.track_id
 
     def pick_track(self):
-        track_id = self.pick_track_id()
-        self.sp.user_playlist_add_tracks(self.username, self.playlist, [track_id])
+        with tracing.span('pick_track'):
+            track_id = self.pick_track_id()
+            result = self.sp.user_playlist_add_tracks(self.username, self.playlist, [track_id])
+            self.added(track_id, result)
+            return track_id
+
+    def added(self, track_id, result):
+        """
+        Keep track of a track the DJ added to the party playlist
+
+        :param result: Spotify's response to adding it
+        """
+        self.history.add(track_id)
+        snapshot_id = result and result.get('snapshot_id')
+        self.mirror.added([track_id], snapshot_id)
+        if self.seed_playlist.playlist == self.playlist:
+            self.seed_playlist.added([track_id], snapshot_id)
+
+    def lead(self, ttl):
+        """
+        Claim (or renew) this DJ's leadership of the party. When several
+        processes share the party, only the leader picks tracks.
+
+        :rtype: bool
+        """
+        return self.party.store.claim_leader(self.dj_id, ttl)
 
     def mix(self):
+        self.token_refresher.ready.wait()
+        while not self.lead(self.LEADER_TTL):
+            time.sleep(self.LEADER_TTL / 2)
+        logger.info("DJ {} is leading the party.".format(self.dj_id))
+        self.recommendations.start()
         self.pick_track()
 
         while True:
             try:
-                remaining_sec, track_id = self.remaining_playback()
-
-                # pick a new track if this is one of the last 5 tracks in the
-                # playlist
-                if track_id in self.last_tracks(self.playlist, num=5):
-                    self.pick_track()
-
-                # otherwise, sleep
-                else:
-                    remaining_sec += 2 # sleep at least 2 seconds
-                    logger.info("Status: {} tracks with votes; {} tracks enqueued to play".format(len(self.track_map), len(self.track_queue)))
-                    logger.info("The current track is not one of the last 5 in the playlist; sleeping for {} seconds.".format(remaining_sec))
-                    time.sleep(remaining_sec)
+                with tracing.trace('mix'):
+                    if not self.lead(self.LEADER_TTL):
+                        logger.warning("Another DJ is leading the party; waiting {} seconds.".format(self.LEADER_TTL / 2))
+                        self.schedule.reset()
+                        time.sleep(self.LEADER_TTL / 2)
+                        continue
+
+                    if not self.schedule.synced:
+                        remaining_sec, track_id = self.remaining_playback()
+                        self.sync(track_id, remaining_sec, self.last_tracks(num=self.schedule.lookahead + 1, current=track_id))
+
+                    # keep enough tracks lined up behind the current one
+                    while self.schedule.needs_track():
+                        self.schedule.add(self.pick_track())
+
+                    # sleep until the current track is over, holding on to the
+                    # party until then
+                    sleep_sec = self.schedule.time_left() + 2 # sleep at least 2 seconds
+                    self.lead(sleep_sec + self.LEADER_TTL)
+                    self.log_status(sleep_sec)
+                    with tracing.span('sleep'):
+                        time.sleep(sleep_sec)
+
+                    # check that the track we expected is the one playing now
+                    remaining_sec, track_id = self.remaining_playback()
+                    if not self.schedule.advance(track_id, remaining_sec):
+                        logger.warning("Playback does not match the schedule; re-reading the playlist.")
+                    self.announce()
 
             except Exception:
+                self.schedule.reset()
                 logger.exception("DJ caught error while mixing; sleeping 5 seconds.")
                 time.sleep(5)
 
-    def request(self, guest, title, artist=None):
-        assert isinstance(guest, Guest)
-        assert isinstance(title, str)
+    def sync(self, track_id, remaining_sec, tail):
+        """
+        Rebuild the schedule from the playback state and the IDs of the last
+        tracks in the playlist, which count as played
+        """
+        self.history.add(track_id)
+        self.history.add_all(tail)
+        self.schedule.sync(track_id, remaining_sec, tail)
+        self.announce()
+
+    def log_status(self, sleep_sec):
+        logger.info("Status: {} tracks with votes; {} tracks enqueued to play".format(self.party.store.track_count(), self.party.store.queue_length()))
+        logger.info("Search cache: {}; {} searches shared with a request in flight".format(self.search_cache, self.searches_in_flight.shared))
+        logger.info("Track catalog: {}".format(self.catalog))
+        logger.info("{} tracks ({:.0f} minutes of music) are lined up behind the current track; sleeping for {} seconds.".format(
+            len(self.schedule.upcoming), self.schedule.playtime(self.tracks.duration) / 60, sleep_sec))
+
+    def search(self, title, artist=None):
+        """
+        Find the track a guest is asking for, consulting the search cache and
+        the catalog of tracks seen so far before asking Spotify. Concurrent
+        identical searches share a single call to Spotify.
+
+        :return: the track's TrackInfo, or None if Spotify found no tracks
+        :rtype: TrackInfo
+        """
+        with tracing.span('search') as span:
+            key = SearchCache.key(title, artist)
+            hit, info = self.search_locally(key, title, artist, span)
+            if hit:
+                return info
+            span.set('source', 'spotify')
+            return self.searches_in_flight.do(key, self._search_spotify, key, title, artist)
+
+    def search_locally(self, key, title, artist, span=tracing.NULL_SPAN):
+        """
+        :param span: the search's tracing span, told which answered it
+        :return: (True, TrackInfo or None) if the search cache or the catalog
+        can answer the search, otherwise (False, None)
+        """
+        hit, info = self.search_cache.get(key)
+        if hit:
+            span.set('source', 'cache')
+            return True, info
+        info = self.catalog.find(title, artist)
+        if info is not None:
+            span.set('source', 'catalog')
+            self.search_cache.put(key, info)
+            return True, info
+        return False, None
+
+    def _search_spotify(self, key, title, artist):
+        search_results = self.sp.search(self.search_query(title, artist), 10, type='track')
+        return self.search_result(key, search_results)
+
+    @staticmethod
+    def search_query(title, artist=None):
         # construct the query
         query = 'track:' + title
         if artist:
             query += ' AND artist:' + artist
+        return query
+
+    def search_result(self, key, search_results):
+        """
+        Keep the tracks Spotify found and cache the one the guest gets
+
+        :return: the track's TrackInfo, or None if Spotify found no tracks
+        """
+        tracks_found_from_search = self.remember(search_results['tracks']['items'])
+        info = tracks_found_from_search.pop() if tracks_found_from_search else None
+        self.search_cache.put(key, info)
+        return info
 
-        # search
-        search_results = self.sp.search(query, 10, type='track')
-        tracks_found_from_search = search_results['tracks']['items']
-        if len(tracks_found_from_search) == 0:
-            raise PartyFoul("No tracks found for {}".format(query))
-        requested_track = tracks_found_from_search.pop()
-        track_id = requested_track['id']
+    def find_track(self, title, artist=None):
+        """
+        Like `search`, but a request that matches nothing is a PartyFoul
 
+        :rtype: TrackInfo
+        """
+        try:
+            requested_track = self.search(title, artist)
+        except RateLimited as e:
+            raise self.busy(e)
+        return self.check_found(requested_track, title, artist)
+
+    @staticmethod
+    def busy(rate_limited):
+        # searches are the first calls to go when Spotify is rate limiting
+        # us, so playback is not held up
+        return SpotifyBusy("Too many requests right now; try again in {:.0f} seconds".format(rate_limited.retry_after))
+
+    @staticmethod
+    def check_found(requested_track, title, artist):
+        if requested_track is None:
+            raise TrackNotFound("No tracks found for {}".format(' by '.join(filter(None, (title, artist)))))
+        return requested_track
+
+    def check_vote(self, guest_key, requested_track):
+        """
+        Raise the PartyFoul that the guest's vote for a track would be turned
+        away with, if any
+        """
         # explicit track filtering
-        if self.block_explicit and requested_track['explicit']:
-            raise PartyFoul("Blocking '{}' ({}) for explicit content".format(requested_track['name'], requested_track['uri']))
+        if self.block_explicit and requested_track.explicit:
+            raise ExplicitTrack("Blocking '{}' ({}) for explicit content".format(requested_track.name, requested_track.uri))
 
-        # create the Track object if it doesn't exist
-        if not track_id in self.track_map:
-            self.track_map[track_id] = Track(track_id)
-        track = self.track_map[track_id]
+        if requested_track.track_id in self.history:
+            raise AlreadyPlayed("'{}' ({}) has been played recently".format(requested_track.name, requested_track.uri))
 
         # block the vote if the guest has already requested the track more than half of the total votes
-        if track.requests.get(guest.key, 0) > 0.5 * track.votes:
-            raise PartyFoul("Guest {} is not allowed to vote because they have already voted for this track {} times.".format(guest.key, track.requests.get(guest.key, 0)))
+        votes, guest_votes = self.party.store.track_votes(requested_track.track_id, guest_key)
+        if guest_votes > 0.5 * votes:
+            raise PartyFoul("Guest {} is not allowed to vote because they have already voted for this track {} times.".format(guest_key, guest_votes))
+
+    def vote(self, guest_key, requested_track):
+        """
+        Count a guest's vote for a track that was found on Spotify. The
+        caller must be inside a store transaction.
+        """
+        store = self.party.store
+        track_id = requested_track.track_id
+        self.check_vote(guest_key, requested_track)
 
         # vote for the track
-        self.track_map[track_id].vote(guest)
-        logger.info("Guest {} voted for '{}' ({})".format(guest, requested_track['name'], requested_track['uri']))
+        with tracing.span('vote'):
+            votes = store.add_vote(track_id, guest_key)
+        logger.info("Guest {} voted for '{}' ({})".format(guest_key, requested_track.name, requested_track.uri))
 
         # the track can be added to the queue if the guest does not request
         # much or if the track has more than one vote
-        if track not in self.track_queue and (track.votes > 1 or guest.requests < 3):
-            heapq.heappush(self.track_queue, track)
-            logger.info("Added '{}' ({}) to queue.".format(requested_track['name'], requested_track['uri']))
+        if not store.is_queued(track_id):
+            if votes > 1 or store.guest_requests(guest_key) < 3:
+                store.enqueue(track_id)
+                logger.info("Added '{}' ({}) to queue.".format(requested_track.name, requested_track.uri))
+                self.feed.publish('enqueue', self.track_json(track_id, votes=votes))
+        else:
+            self.feed.publish('vote', {"id": track_id, "votes": votes})
 
 class Bouncer:
 
     def __init__(self, party):
         self.party = party
-        self.total_requests = 0
-        self.guests = dict()
 
-    def add_guest(self, guest_key):
-        if guest_key not in self.guests:
-            self.guests[guest_key] = Guest(guest_key)
-            logger.info("New guest: " + guest_key)
+    @property
+    def total_requests(self):
+        return self.party.store.total_requests()
 
-    def find_guest(self, guest_key):
-        if guest_key not in self.guests:
-            self.add_guest(guest_key)
-        return self.guests[guest_key]
+    def add_guest(self, guest_key):
+        self.party.store.add_guest(guest_key)
 
     def request(self, guest_key, title, artist):
         pass
@@ -293,24 +659,159 @@ class PercentBouncer(Bouncer):
     # period
     THRESHOLD = 0.5
 
-    def request(self, guest_key, title, artist):
-        guest = self.find_guest(guest_key)
+    def __init__(self, party):
+        super().__init__(party)
+        # how often each guest may make a request, whatever becomes of it
+        self.rate_limit = SlidingWindow()
+        # the tracks that each guest's recent requests turned out to be
+        self.recent_requests = RecentRequests()
 
+    def check(self, guest_key):
         # check if the guest is "over the legal limit"
-        if guest.requests >= self.GRACE and guest.requests / \
+        requests = self.party.store.guest_requests(guest_key)
+        if requests >= self.GRACE and requests / \
                 max(self.total_requests, 1) > self.THRESHOLD:
-            raise PartyFoul("Guest {} is over the limit.".format(guest.key))
+            raise PartyFoul("Guest {} is over the limit.".format(guest_key))
+
+    def screen(self, guest_key, key):
+        """
+        Turn a request away before searching for it: if the guest is sending
+        too many, is over the limit, or recently made the same request and
+        would be refused again
+
+        :param key: the request's `SearchCache.key`
+        :return: the track the same request found recently, if any
+        :rtype: dict
+        """
+        with tracing.span('screen'):
+            if not self.rate_limit.allow(guest_key):
+                raise TooManyRequests("Guest {} is sending requests too quickly.".format(guest_key))
+            self.check(guest_key)
+            requested_track = self.recent_requests.get(guest_key, key)
+            if requested_track is not None:
+                self.party.dj.check_vote(guest_key, requested_track)
+            return requested_track
+
+    def request(self, guest_key, title, artist):
+        with tracing.trace('request', guest=guest_key) as span:
+            try:
+                key = SearchCache.key(title, artist)
+                requested_track = self.screen(guest_key, key)
+                if requested_track is None:
+                    # search for the track outside of the store transaction
+                    requested_track = self.party.dj.find_track(title, artist)
+                    self.recent_requests.put(guest_key, key, requested_track)
+                self.admit(guest_key, requested_track)
+            except PartyFoul as e:
+                span.set('outcome', self.count_outcome(e))
+                raise
+            span.set('outcome', self.count_outcome(None))
+
+    def request_batch(self, requests):
+        """
+        Handle several requests at once, searching Spotify only once for each
+        distinct track
+
+        :param requests: list of (guest key, title, artist) tuples
+        :return: for each request, None if it was accepted or the PartyFoul
+        that rejected it
+        :rtype: list
+        """
+        with tracing.trace('request_batch', size=len(requests)):
+            results, recalled, searches = self.screen_batch(requests)
+
+            found = {}
+            for key, (title, artist) in searches.items():
+                try:
+                    found[key] = self.party.dj.find_track(title, artist)
+                except PartyFoul as e:
+                    found[key] = e
 
-        # pass the request to the DJ
-        self.party.dj.request(guest, title, artist)
+            return self.admit_batch(requests, results, recalled, found)
+
+    def screen_batch(self, requests):
+        """
+        Screen each request in a batch
 
-        # increment count of requests if this request was completed without
-        # error
-        self.total_requests += 1
-        guest.requests += 1
+        :return: the PartyFoul (or None) for each request, the track each
+        request recalled (or None), and the searches the rest need, keyed by
+        `SearchCache.key`
+        """
+        results = [None] * len(requests)
+        recalled = [None] * len(requests)
+        searches = {}
+        for i, (guest_key, title, artist) in enumerate(requests):
+            key = SearchCache.key(title, artist)
+            try:
+                recalled[i] = self.screen(guest_key, key)
+            except PartyFoul as e:
+                results[i] = e
+                continue
+            if recalled[i] is None:
+                searches.setdefault(key, (title, artist))
+        return results, recalled, searches
+
+    def admit_batch(self, requests, results, recalled, found):
+        """
+        Admit the screened requests of a batch in order, given the track (or
+        PartyFoul) each search found
+        """
+        for i, (guest_key, title, artist) in enumerate(requests):
+            if results[i] is not None:
+                continue
+            requested_track = recalled[i]
+            try:
+                if requested_track is None:
+                    key = SearchCache.key(title, artist)
+                    requested_track = found[key]
+                    if isinstance(requested_track, PartyFoul):
+                        raise requested_track
+                    self.recent_requests.put(guest_key, key, requested_track)
+                self.admit(guest_key, requested_track)
+            except PartyFoul as e:
+                results[i] = e
+
+        for foul in results:
+            self.count_outcome(foul)
+        return results
+
+    @staticmethod
+    def count_outcome(foul):
+        """
+        :return: the outcome the request was counted under
+        :rtype: str
+        """
+        if foul is None:
+            outcome = 'accepted'
+        elif isinstance(foul, ExplicitTrack):
+            outcome = 'explicit'
+        elif isinstance(foul, TrackNotFound):
+            outcome = 'not_found'
+        elif isinstance(foul, SpotifyBusy):
+            outcome = 'busy'
+        elif isinstance(foul, TooManyRequests):
+            outcome = 'rate_limited'
+        elif isinstance(foul, AlreadyPlayed):
+            outcome = 'played'
+        else:
+            outcome = 'partyfoul'
+        metrics.REQUESTS.inc(outcome)
+        return outcome
+
+    def admit(self, guest_key, requested_track):
+        with tracing.span('admit'), self.party.store.transaction():
+            # the guest may have had other requests counted during the search
+            self.check(guest_key)
+
+            # pass the request to the DJ
+            self.party.dj.vote(guest_key, requested_track)
+
+            # increment count of requests if this request was completed
+            # without error
+            self.party.store.count_request(guest_key)
 
 class Party:
     """
     Vessel to contain all the necessary elements of a good party
     """
-    __slots__ = ('bouncer', 'config', 'dj', 'sp_oauth')
+    __slots__ = ('bouncer', 'config', 'dj', 'intake', 'sp_oauth', 'store')
@@ -0,0 +1,145 @@
+#!/usr/bin/env false
+import collections
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SeedPlaylist:
+    """
+    Track IDs of the playlist used to seed recommendations, downloaded again
+    only when the playlist's snapshot_id changes. When the seed playlist is
+    the party playlist, tracks the DJ adds to it are recorded with the
+    snapshot_id the addition produced, like PlaylistMirror does, so the DJ's
+    own additions do not make it download the playlist again.
+    """
+
+    SNAPSHOT_FIELDS = 'snapshot_id'
+    TRACK_FIELDS = 'snapshot_id,tracks.items(track(id))'
+    # tracks Spotify includes in a playlist's JSON
+    PAGE = 100
+
+    def __init__(self, username=None, playlist=None):
+        self.username = username
+        self.playlist = playlist
+        self.snapshot_id = None
+        self.track_ids = []
+
+    def load(self, sp):
+        """
+        :return: IDs of the tracks in the playlist
+        :rtype: list
+        """
+        snapshot_id = sp.user_playlist(self.username, playlist_id=self.playlist, fields=self.SNAPSHOT_FIELDS)['snapshot_id']
+        if snapshot_id != self.snapshot_id:
+            self.update(sp.user_playlist(self.username, playlist_id=self.playlist, fields=self.TRACK_FIELDS))
+        return self.track_ids
+
+    def update(self, playlist_data):
+        self.track_ids = [item['track']['id'] for item in playlist_data['tracks']['items'] if item['track']]
+        self.snapshot_id = playlist_data['snapshot_id']
+        logger.info("Loaded {} seed tracks from playlist {}".format(len(self.track_ids), self.playlist))
+
+    def added(self, track_ids, snapshot_id):
+        """
+        Record tracks the DJ added to the end of the playlist, and the
+        snapshot_id Spotify returned for the addition
+        """
+        if self.snapshot_id is None or not snapshot_id:
+            # not loaded yet, or we cannot tell what the playlist is now
+            self.snapshot_id = None
+            return
+        # the same tracks a download would find
+        self.track_ids.extend(track_ids[:self.PAGE - len(self.track_ids)])
+        self.snapshot_id = snapshot_id
+
+
+class RecommendationPool:
+    """
+    Buffer of recommended tracks that have already been filtered for explicit
+    content. A background thread refills it whenever it drops below
+    `LOW_WATER` tracks, so picking a fallback track does not wait on Spotify.
+    """
+
+    LOW_WATER = 5
+
+    def __init__(self, dj):
+        self.dj = dj
+        self._tracks = collections.deque()
+        self._lock = threading.Lock()
+        self._low = threading.Event()
+        self._low.set()
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def start(self):
+        threading.Thread(target=self.run, name='recommendations', daemon=True).start()
+
+    def run(self):
+        self.dj.token_refresher.ready.wait()
+        while True:
+            self._low.wait()
+            self._low.clear()
+            try:
+                while len(self._tracks) < self.LOW_WATER:
+                    if not self.fill():
+                        raise Exception("Spotify did not recommend any playable tracks")
+            except Exception:
+                logger.exception("Failed to refill the recommendation pool; retrying in 5 seconds.")
+                self._low.set()
+                time.sleep(5)
+
+    def fill(self):
+        """
+        :return: the number of tracks added to the pool
+        """
+        return self.add(self.dj.recommend_tracks())
+
+    def add(self, track_list):
+        """
+        :return: the number of tracks added to the pool
+        """
+        # filter out explicit tracks
+        if self.dj.block_explicit:
+            track_list = [t for t in track_list if not t.explicit]
+        # and tracks that have played recently
+        track_list = [t for t in track_list if t.track_id not in self.dj.history]
+        random.shuffle(track_list)
+        with self._lock:
+            self._tracks.extend(track_list)
+        return len(track_list)
+
+    def take(self):
+        """
+        Take the next recommended track that has not played since it was
+        recommended, if there is one
+
+        :rtype: TrackInfo
+        """
+        with self._lock:
+            info = None
+            while self._tracks and info is None:
+                info = self._tracks.popleft()
+                if info.track_id in self.dj.history:
+                    info = None
+            if len(self._tracks) < self.LOW_WATER:
+                self._low.set()
+        return info
+
+    def pop(self):
+        """
+        Take the next recommended track, fetching recommendations right away
+        only if the pool ran dry
+
+        :rtype: TrackInfo
+        """
+        while True:
+            info = self.take()
+            if info is not None:
+                return info
+            if not self.fill():
+                raise Exception("Spotify did not recommend any playable tracks")
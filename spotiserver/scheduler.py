@@ -0,0 +1,141 @@
+#!/usr/bin/env false
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MixSchedule:
+    """
+    The DJ's picture of the party playlist: the track that is playing, when
+    it ends, and the tracks lined up behind it. Knowing when the current
+    track ends lets the DJ sleep until then instead of polling Spotify.
+    """
+
+    def __init__(self, lookahead=5):
+        # number of tracks to keep lined up behind the current track
+        self.lookahead = lookahead
+        self.current = None
+        self.deadline = 0
+        self.upcoming = collections.deque()
+
+    @property
+    def synced(self):
+        return self.current is not None
+
+    def reset(self):
+        self.current = None
+        self.upcoming.clear()
+
+    def sync(self, track_id, remaining_sec, tail):
+        """
+        Rebuild the schedule from the playback state and the IDs of the last
+        tracks in the playlist
+        """
+        self.current = track_id
+        self.deadline = time.time() + remaining_sec
+        if track_id in tail:
+            position = len(tail) - 1 - tail[::-1].index(track_id)
+            self.upcoming = collections.deque(tail[position + 1:])
+        else:
+            # the current track is further back than the tail, so at least
+            # the whole tail is still to come
+            self.upcoming = collections.deque(tail)
+
+    def needs_track(self):
+        return len(self.upcoming) < self.lookahead
+
+    def add(self, track_id):
+        self.upcoming.append(track_id)
+
+    def time_left(self):
+        """
+        :return: seconds until the current track ends
+        """
+        return max(self.deadline - time.time(), 0)
+
+    def playtime(self, duration):
+        """
+        :param duration: function giving a track's length in seconds, or None
+        if it is not known
+        :return: seconds until the lined up tracks have all played, counting
+        only the tracks whose length is known
+        """
+        return self.time_left() + sum(duration(track_id) or 0 for track_id in self.upcoming)
+
+    def advance(self, track_id, remaining_sec):
+        """
+        Move the schedule along once Spotify reports the track that is now
+        playing
+
+        :return: False if playback does not match the schedule and it has to
+        be rebuilt
+        """
+        if track_id == self.current:
+            # woke up a little early
+            self.deadline = time.time() + remaining_sec
+            return True
+        if not self.upcoming or self.upcoming[0] != track_id:
+            self.reset()
+            return False
+        self.upcoming.popleft()
+        self.current = track_id
+        self.deadline = time.time() + remaining_sec
+        return True
+
+
+class PlaylistMirror:
+    """
+    The last `size` tracks of the party playlist, as of Spotify's
+    `snapshot_id` for it. Tracks the DJ adds are appended as Spotify accepts
+    them, along with the snapshot_id that the addition produced, so the
+    playlist only has to be read again when someone else changes it.
+    """
+
+    # what the DJ asks Spotify for to tell whether the mirror is current
+    FIELDS = 'snapshot_id,tracks.total'
+
+    def __init__(self, size=50):
+        self.size = size
+        self.snapshot_id = None
+        self._tail = collections.deque(maxlen=size)
+
+    def current(self, playlist_data, track_id=None):
+        """
+        :param playlist_data: the playlist's FIELDS
+        :param track_id: a track that should be in the mirror, if it is current
+        :rtype: bool
+        """
+        if playlist_data['snapshot_id'] != self.snapshot_id:
+            return False
+        return track_id is None or track_id in self._tail
+
+    def offset(self, playlist_data):
+        """
+        :return: where in the playlist the tracks to load start
+        """
+        return max(playlist_data['tracks']['total'] - self.size, 0)
+
+    def load(self, playlist_data, track_ids):
+        self._tail = collections.deque(track_ids, maxlen=self.size)
+        self.snapshot_id = playlist_data['snapshot_id']
+
+    def added(self, track_ids, snapshot_id):
+        """
+        Record tracks the DJ added to the end of the playlist, and the
+        snapshot_id Spotify returned for the addition
+        """
+        if self.snapshot_id is None or not snapshot_id:
+            # not loaded yet, or we cannot tell what the playlist is now
+            self.snapshot_id = None
+            return
+        self._tail.extend(track_ids)
+        self.snapshot_id = snapshot_id
+
+    def tail(self, num):
+        """
+        :return: the IDs of the last `num` tracks
+        :rtype: list
+        """
+        return list(self._tail)[-num:]
@@ -2,13 +2,31 @@
 import logging
 from flask import Flask, request, Response, json, redirect, render_template
 from flask_bootstrap import Bootstrap
-from .party import PartyFoul
+from . import metrics
+from .intake import IntakeFull
+from .party import PartyFoul, SpotifyBusy
 
 logger = logging.getLogger(__name__)
 app = Flask(__name__)
+# most requests accepted by a single call to /requests
+MAX_BATCH = 500
 Bootstrap(app)
 
 
+def valid_request(item):
+    """
+    :return: whether an item of a /requests batch names a listener, a track
+    and optionally an artist, each as a non-empty string
+    :rtype: bool
+    """
+    if not isinstance(item, dict):
+        return False
+    fields = [item.get('listener'), item.get('track')]
+    if item.get('artist') is not None:
+        fields.append(item['artist'])
+    return all(isinstance(field, str) and field.strip() for field in fields)
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -31,6 +49,8 @@ def callback():
     # https://accounts.spotify.com/api/token and stores them in the local cache
     # file
     app.party.sp_oauth.get_access_token(code)
+    # hand the new token to the DJ right away
+    app.party.dj.token_refresher.refresh()
 
     return Response(response=json.dumps({
         "ok": True,
@@ -44,8 +64,26 @@ def process_request():
     track = request.args['track']
     artist = request.args['artist']
 
+    # hand out a ticket right away if requests are resolved in the background
+    if app.party.intake:
+        try:
+            ticket = app.party.intake.submit(listener, track, artist)
+        except IntakeFull as e:
+            logger.warning(str(e))
+            return Response(response=json.dumps({
+                "ok": False,
+                "message": str(e)
+            }), status=503)
+        return Response(response=json.dumps(ticket.to_json()), status=202)
+
     try:
         app.party.bouncer.request(listener, track, artist)
+    except SpotifyBusy as e:
+        logger.warning(str(e))
+        return Response(response=json.dumps({
+            "ok": False,
+            "message": str(e)
+        }), status=503)
     except PartyFoul as e:
         logger.warning(str(e))
         return Response(response=json.dumps({
@@ -59,3 +97,79 @@ def process_request():
         "ok": True,
         "message": "Added request"
     }), status=200)
+
+
+@app.route('/request/<ticket_id>')
+def request_status(ticket_id):
+    ticket = app.party.intake.status(ticket_id) if app.party.intake else None
+    if ticket is None:
+        return Response(response=json.dumps({
+            "ok": False,
+            "message": "Unknown ticket {}".format(ticket_id)
+        }), status=404)
+
+    return Response(response=json.dumps(ticket.to_json()), status=200)
+
+
+@app.route('/queue')
+def queue():
+    """
+    The track that is playing and the queued tracks, in the order they will
+    play. Conditional GETs are answered with 304 until the queue changes.
+    """
+    version, body = app.party.dj.queue_snapshot.get()
+    etag = '"{}"'.format(version)
+    if request.if_none_match.contains(version):
+        return Response(status=304, headers={'ETag': etag})
+    return Response(response=body, status=200, mimetype='application/json',
+                    headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+
+@app.route('/queue/events')
+def queue_events():
+    """
+    Stream changes to the queue as Server-Sent Events
+    """
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    events = app.party.dj.feed.stream(int(last_event_id) if last_event_id.isdigit() else None)
+    return Response(response=events, status=200, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/metrics')
+def process_metrics():
+    return Response(response=metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/requests', methods=['POST'])
+def process_requests():
+    """
+    Accept a JSON array of requests, each with a listener, track and
+    optionally an artist
+    """
+    batch = request.get_json(silent=True)
+    if not isinstance(batch, list) or not all(valid_request(item) for item in batch):
+        return Response(response=json.dumps({
+            "ok": False,
+            "message": "Expected a JSON array of requests with a listener, a track and optionally an artist, each a non-empty string"
+        }), status=400)
+    if len(batch) > MAX_BATCH:
+        return Response(response=json.dumps({
+            "ok": False,
+            "message": "At most {} requests may be sent at once".format(MAX_BATCH)
+        }), status=413)
+
+    results = app.party.bouncer.request_batch([(item['listener'], item['track'], item.get('artist')) for item in batch])
+
+    response = []
+    for item, foul in zip(batch, results):
+        if foul is not None:
+            logger.warning(str(foul))
+            response.append({"ok": False, "message": str(foul)})
+        else:
+            logger.info("Request for track {} by guest {} succeeded".format(item['track'], item['listener']))
+            response.append({"ok": True, "message": "Added request"})
+    return Response(response=json.dumps({
+        "ok": True,
+        "results": response
+    }), status=200)
@@ -0,0 +1,543 @@
+#!/usr/bin/env false
+import collections
+import contextlib
+import heapq
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from .party import Guest, Track, TrackQueue, add_log2
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Where the party keeps its guests, votes and track queue. The Bouncer and
+    the DJ make every change inside `transaction()`, so a store that is shared
+    by several processes can apply each request atomically.
+    """
+
+    # seconds for a vote's weight to halve, or 0 to rank queued tracks by
+    # their number of votes
+    half_life = 0
+
+    def vote_weight(self, when):
+        """
+        Each vote weighs 2 ** (when / half_life), so a track's total weight,
+        decayed to any moment, ranks it the same as its total at time 0 does.
+        Keeping the log2 of that total as the track's score means the score
+        only changes when the track gets a vote, and the queue never has to be
+        reordered as time passes.
+
+        :return: log2 of the weight of a vote made at `when`
+        :rtype: float
+        """
+        return when / self.half_life if self.half_life else 0.0
+
+    def transaction(self):
+        raise NotImplementedError
+
+    def add_guest(self, guest_key):
+        raise NotImplementedError
+
+    def guest_requests(self, guest_key):
+        """
+        :return: the number of requests the guest has had accepted
+        """
+        raise NotImplementedError
+
+    def total_requests(self):
+        raise NotImplementedError
+
+    def count_request(self, guest_key):
+        """
+        Record an accepted request from the guest
+        """
+        raise NotImplementedError
+
+    def track_votes(self, track_id, guest_key):
+        """
+        :return: total votes for the track, votes for the track by the guest
+        """
+        raise NotImplementedError
+
+    def add_vote(self, track_id, guest_key):
+        """
+        Count a vote for the track, reordering the queue if it is enqueued
+
+        :return: the track's new vote total
+        """
+        raise NotImplementedError
+
+    def is_queued(self, track_id):
+        raise NotImplementedError
+
+    def enqueue(self, track_id):
+        raise NotImplementedError
+
+    def pop_track(self):
+        """
+        Remove the track with the most votes from the queue and forget its
+        votes
+
+        :return: the track's spotify id and the time it was queued, or
+        (None, None) if the queue is empty
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def queue_version(self):
+        """
+        :return: a number that changes whenever the queue does: a queued track
+        gets a vote, or a track is enqueued or popped
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def queued_tracks(self, limit=50):
+        """
+        :return: (spotify id, votes) of the first `limit` tracks in the queue,
+        in the order they will be played
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def guest_count(self):
+        raise NotImplementedError
+
+    def track_count(self):
+        raise NotImplementedError
+
+    def queue_length(self):
+        raise NotImplementedError
+
+    def claim_leader(self, owner, ttl):
+        """
+        Try to become (or stay) the one DJ that picks tracks for the party
+        for the next `ttl` seconds
+
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def add_played(self, track_ids, keep):
+        """
+        Remember tracks added to the party playlist, forgetting all but the
+        last `keep`
+        """
+        raise NotImplementedError
+
+    def played_since(self, seq):
+        """
+        :return: (sequence number, spotify id) of the remembered tracks added
+        to the party playlist after `seq`, oldest first
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def set_playing(self, track):
+        """
+        Show viewers of the queue the track that is playing, changing the
+        queue version if it is a different one
+
+        :param track: what viewers are shown about the track, or None
+        """
+        raise NotImplementedError
+
+    def now_playing(self):
+        """
+        :return: what viewers are shown about the track that is playing, or
+        None
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+
+class MemoryStore(StateStore):
+    """
+    Party state kept in this process. Changes are written to `journal`, if
+    there is one, so that they survive a restart.
+    """
+
+    def __init__(self):
+        self.journal = None
+        self.lock = threading.RLock()
+        self.total = 0
+        self.version = 0
+        self.guests = dict()
+        # map of all tracks
+        self.track_map = {}
+        # queue of tracks that are about to play
+        self.track_queue = TrackQueue()
+        # (sequence number, spotify id) of tracks added to the party
+        # playlist; not journaled, since the DJ reads them back from the
+        # playlist when it starts
+        self.played = collections.deque()
+        self.played_seq = 0
+        # the track that is playing, as shown to viewers; not journaled
+        # either, since the DJ finds out again from Spotify
+        self.playing = None
+
+    def transaction(self):
+        return self.lock
+
+    def _record(self, *record):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def add_guest(self, guest_key):
+        with self.lock:
+            if guest_key not in self.guests:
+                self.guests[guest_key] = Guest(guest_key)
+                logger.debug("New guest: {}".format(guest_key))
+
+    def guest_requests(self, guest_key):
+        guest = self.guests.get(guest_key)
+        return guest.requests if guest else 0
+
+    def total_requests(self):
+        return self.total
+
+    def count_request(self, guest_key):
+        with self.lock:
+            self.add_guest(guest_key)
+            self.guests[guest_key].requests += 1
+            self.total += 1
+            self._record('r', guest_key)
+
+    def track_votes(self, track_id, guest_key):
+        track = self.track_map.get(track_id)
+        if track is None:
+            return 0, 0
+        return track.votes, track.requests.get(guest_key, 0)
+
+    def add_vote(self, track_id, guest_key, time_created=None, time_voted=None):
+        with self.lock:
+            # create the Track object if it doesn't exist
+            if track_id not in self.track_map:
+                self.track_map[track_id] = Track(track_id)
+                if time_created:
+                    self.track_map[track_id]._time_created = time_created
+            track = self.track_map[track_id]
+            time_voted = time_voted or time.time()
+            track.vote(guest_key, self.vote_weight(time_voted))
+            if track in self.track_queue:
+                self.track_queue.update(track)
+                self.version += 1
+            self._record('v', track_id, guest_key, track._time_created, time_voted)
+            return track.votes
+
+    def is_queued(self, track_id):
+        track = self.track_map.get(track_id)
+        return track is not None and track in self.track_queue
+
+    def enqueue(self, track_id):
+        with self.lock:
+            track = self.track_map[track_id]
+            track._time_queued = time.time()
+            self.track_queue.push(track)
+            self.version += 1
+            self._record('q', track_id)
+
+    def pop_track(self):
+        with self.lock:
+            if not self.track_queue:
+                return None, None
+            track = self.track_queue.pop()
+            track.reset()
+            self.version += 1
+            self._record('p')
+            return track.spotify_id, track._time_queued
+
+    def queue_version(self):
+        return self.version
+
+    def queued_tracks(self, limit=50):
+        with self.lock:
+            return [(track.spotify_id, track.votes) for track in heapq.nsmallest(limit, self.track_queue)]
+
+    def guest_count(self):
+        return len(self.guests)
+
+    def track_count(self):
+        return len(self.track_map)
+
+    def queue_length(self):
+        return len(self.track_queue)
+
+    def claim_leader(self, owner, ttl):
+        return True
+
+    def add_played(self, track_ids, keep):
+        with self.lock:
+            for track_id in track_ids:
+                self.played_seq += 1
+                self.played.append((self.played_seq, track_id))
+            while len(self.played) > keep:
+                self.played.popleft()
+
+    def played_since(self, seq):
+        with self.lock:
+            return [played for played in self.played if played[0] > seq]
+
+    def set_playing(self, track):
+        with self.lock:
+            if track != self.playing:
+                self.playing = track
+                self.version += 1
+
+    def now_playing(self):
+        return self.playing
+
+    def dump(self):
+        """
+        :return: the whole party as JSON-serializable data
+        """
+        with self.lock:
+            return {
+                'total': self.total,
+                'guests': {key: guest.requests for key, guest in self.guests.items()},
+                'tracks': [[track.spotify_id, track._time_created, dict(track.requests), track in self.track_queue,
+                            track.score if track.votes else None]
+                           for track in self.track_map.values()],
+            }
+
+    def load(self, state):
+        """
+        Replace the party with one produced by `dump`
+        """
+        with self.lock:
+            self.total = state['total']
+            self.guests = dict()
+            for key, requests in state['guests'].items():
+                self.guests[key] = Guest(key)
+                self.guests[key].requests = requests
+            self.track_map = {}
+            self.track_queue = TrackQueue()
+            for track_id, time_created, requests, queued, *score in state['tracks']:
+                track = self.track_map[track_id] = Track(track_id)
+                track._time_created = time_created
+                track.requests = requests
+                track.votes = sum(requests.values())
+                if score and score[0] is not None:
+                    track.score = score[0]
+                else:
+                    # saved before votes had weights
+                    for i in range(track.votes):
+                        track.score = add_log2(track.score, 0.0)
+                if queued:
+                    self.track_queue.push(track)
+            self.version += 1
+
+    def replay(self, record):
+        """
+        Apply a change that was written to the journal
+        """
+        op, args = record[0], record[1:]
+        if op == 'r':
+            self.count_request(*args)
+        elif op == 'v':
+            self.add_vote(*args)
+        elif op == 'q':
+            self.enqueue(*args)
+        elif op == 'p':
+            self.pop_track()
+
+
+class SQLiteStore(StateStore):
+    """
+    Party state in a SQLite database on local disk, so that several worker
+    processes can serve the same party. Every transaction takes the database's
+    write lock up front, which makes vote increments and queue changes atomic
+    across processes.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS guests (
+            key TEXT PRIMARY KEY,
+            requests INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            id TEXT PRIMARY KEY,
+            votes INTEGER NOT NULL DEFAULT 0,
+            score REAL,
+            created REAL NOT NULL,
+            queued INTEGER NOT NULL DEFAULT 0,
+            queued_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS tracks_by_score ON tracks (queued, score, created);
+        CREATE TABLE IF NOT EXISTS votes (
+            track_id TEXT NOT NULL,
+            guest_key TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (track_id, guest_key)
+        );
+        CREATE TABLE IF NOT EXISTS played (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            track_id TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS playing (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            track TEXT
+        );
+        CREATE TABLE IF NOT EXISTS leader (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+        INSERT OR IGNORE INTO counters (name, value) VALUES ('total_requests', 0);
+        INSERT OR IGNORE INTO counters (name, value) VALUES ('queue_version', 0);
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        # sqlite connections may not be shared between threads
+        self._local = threading.local()
+        self._db().executescript(self.SCHEMA)
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # NULL is a score of -inf, for a track without votes
+            db.create_function('add_log2', 2, lambda a, b: add_log2(-math.inf if a is None else a, b), deterministic=True)
+            self._local.db = db
+            self._local.depth = 0
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self._db()
+        if self._local.depth:
+            # already inside a transaction on this thread
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        db.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+    def _value(self, sql, *args):
+        row = self._db().execute(sql, args).fetchone()
+        return row[0] if row else None
+
+    def add_guest(self, guest_key):
+        self._db().execute("INSERT OR IGNORE INTO guests (key) VALUES (?)", (guest_key,))
+
+    def guest_requests(self, guest_key):
+        return self._value("SELECT requests FROM guests WHERE key = ?", guest_key) or 0
+
+    def total_requests(self):
+        return self._value("SELECT value FROM counters WHERE name = 'total_requests'")
+
+    def count_request(self, guest_key):
+        with self.transaction():
+            db = self._db()
+            db.execute("INSERT OR IGNORE INTO guests (key) VALUES (?)", (guest_key,))
+            db.execute("UPDATE guests SET requests = requests + 1 WHERE key = ?", (guest_key,))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'total_requests'")
+
+    def track_votes(self, track_id, guest_key):
+        votes = self._value("SELECT votes FROM tracks WHERE id = ?", track_id) or 0
+        guest_votes = self._value("SELECT count FROM votes WHERE track_id = ? AND guest_key = ?", track_id, guest_key) or 0
+        return votes, guest_votes
+
+    def add_vote(self, track_id, guest_key):
+        with self.transaction():
+            db = self._db()
+            db.execute("INSERT OR IGNORE INTO tracks (id, created) VALUES (?, ?)", (track_id, time.time()))
+            db.execute("UPDATE tracks SET votes = votes + 1, score = add_log2(score, ?) WHERE id = ?", (self.vote_weight(time.time()), track_id))
+            db.execute("INSERT OR IGNORE INTO votes (track_id, guest_key) VALUES (?, ?)", (track_id, guest_key))
+            db.execute("UPDATE votes SET count = count + 1 WHERE track_id = ? AND guest_key = ?", (track_id, guest_key))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'queue_version' AND "
+                       "EXISTS (SELECT 1 FROM tracks WHERE id = ? AND queued = 1)", (track_id,))
+            return self._value("SELECT votes FROM tracks WHERE id = ?", track_id)
+
+    def is_queued(self, track_id):
+        return bool(self._value("SELECT queued FROM tracks WHERE id = ?", track_id))
+
+    def enqueue(self, track_id):
+        with self.transaction():
+            db = self._db()
+            db.execute("UPDATE tracks SET queued = 1, queued_at = ? WHERE id = ?", (time.time(), track_id))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'queue_version'")
+
+    def pop_track(self):
+        with self.transaction():
+            db = self._db()
+            # highest score first; ties go to the newest track, like Track.__lt__
+            row = db.execute("SELECT id, queued_at FROM tracks WHERE queued = 1 ORDER BY score DESC, created DESC LIMIT 1").fetchone()
+            if row is None:
+                return None, None
+            track_id, queued_at = row
+            db.execute("UPDATE tracks SET queued = 0, votes = 0, score = NULL WHERE id = ?", (track_id,))
+            db.execute("DELETE FROM votes WHERE track_id = ?", (track_id,))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'queue_version'")
+        return track_id, queued_at
+
+    def queue_version(self):
+        return self._value("SELECT value FROM counters WHERE name = 'queue_version'")
+
+    def queued_tracks(self, limit=50):
+        return self._db().execute("SELECT id, votes FROM tracks WHERE queued = 1 ORDER BY score DESC, created DESC LIMIT ?", (limit,)).fetchall()
+
+    def guest_count(self):
+        return self._value("SELECT COUNT(*) FROM guests")
+
+    def track_count(self):
+        return self._value("SELECT COUNT(*) FROM tracks")
+
+    def queue_length(self):
+        return self._value("SELECT COUNT(*) FROM tracks WHERE queued = 1")
+
+    def claim_leader(self, owner, ttl):
+        now = time.time()
+        with self.transaction():
+            db = self._db()
+            db.execute("DELETE FROM leader WHERE expires < ?", (now,))
+            db.execute("INSERT OR IGNORE INTO leader (id, owner, expires) VALUES (1, ?, ?)", (owner, now + ttl))
+            db.execute("UPDATE leader SET expires = ? WHERE id = 1 AND owner = ?", (now + ttl, owner))
+            return self._value("SELECT owner FROM leader WHERE id = 1") == owner
+
+    def add_played(self, track_ids, keep):
+        with self.transaction():
+            db = self._db()
+            db.executemany("INSERT INTO played (track_id) VALUES (?)", [(track_id,) for track_id in track_ids])
+            db.execute("DELETE FROM played WHERE seq <= (SELECT MAX(seq) FROM played) - ?", (keep,))
+
+    def played_since(self, seq):
+        return self._db().execute("SELECT seq, track_id FROM played WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+
+    def set_playing(self, track):
+        text = json.dumps(track, sort_keys=True) if track is not None else None
+        with self.transaction():
+            if text == self._value("SELECT track FROM playing WHERE id = 1"):
+                return
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO playing (id, track) VALUES (1, ?)", (text,))
+            db.execute("UPDATE counters SET value = value + 1 WHERE name = 'queue_version'")
+
+    def now_playing(self):
+        text = self._value("SELECT track FROM playing WHERE id = 1")
+        return json.loads(text) if text is not None else None
@@ -0,0 +1,169 @@
+#!/usr/bin/env false
+"""
+Sampled tracing of where the time goes in a request or a DJ.mix iteration.
+
+A sampled trace records how long each stage inside it took, and is written
+to a rotating file in the Trace Event Format, which chrome://tracing and
+https://ui.perfetto.dev open as is. Each trace gets its own row in the
+viewer. Tracing is off until `configure` is given a path; when it is off, or
+a trace is not sampled, a span is a no-op context manager.
+"""
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+
+# the sampled trace that spans on this thread or task belong to
+_current = contextvars.ContextVar('trace', default=None)
+
+_logger = logging.getLogger(__name__)
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+
+_sample_rate = 0.0
+_ids = itertools.count(1)
+
+
+class TraceFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Starts every file with the '[' of a JSON array of trace events. The
+    closing ']' may be left out, so each file can be opened at any time.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        self.setFormatter(logging.Formatter('%(message)s'))
+        self.terminator = ',\n'
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            stream.write('[\n')
+        return stream
+
+
+def configure(path=None, sample_rate=0.01, max_bytes=10 * 1024 * 1024, backups=3):
+    """
+    Start writing a `sample_rate` fraction of traces to `path`, or stop
+    tracing if there is no path
+    """
+    global _sample_rate
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+        handler.close()
+    _sample_rate = 0.0
+    if path and sample_rate > 0:
+        _logger.addHandler(TraceFileHandler(path, max_bytes, backups))
+        _sample_rate = sample_rate
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'args', 'start')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def set(self, key, value):
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.trace.record(self, time.perf_counter())
+        return False
+
+
+class Trace(Span):
+    """
+    The outermost span of a sampled trace, which collects the spans inside
+    it and writes them all out when it ends
+    """
+    __slots__ = ('trace_id', 'events', 'wall', '_token')
+
+    def __init__(self, name, args):
+        super().__init__(self, name, args)
+        self.trace_id = next(_ids)
+        self.events = []
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self.wall = time.time()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        _current.reset(self._token)
+        # spans end before the spans around them, so put them back in order
+        self.events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        _logger.info(',\n'.join(json.dumps(event, separators=(',', ':')) for event in self.events))
+        return False
+
+    def record(self, span, end):
+        self.events.append({
+            "name": span.name,
+            "ph": "X",
+            "ts": round((self.wall + span.start - self.start) * 1e6),
+            "dur": round((end - span.start) * 1e6),
+            "pid": os.getpid(),
+            "tid": self.trace_id,
+            "args": span.args,
+        })
+
+
+class NullSpan:
+    """
+    Stands in for a span that is not being recorded
+    """
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def trace(name, **args):
+    """
+    Start a new trace, if it is sampled and there is no trace going on
+    already; otherwise the same as `span`
+    """
+    if not _sample_rate:
+        return NULL_SPAN
+    current = _current.get()
+    if current is not None:
+        return Span(current, name, args)
+    if random.random() < _sample_rate:
+        args['thread'] = threading.current_thread().name
+        return Trace(name, args)
+    return NULL_SPAN
+
+
+def span(name, **args):
+    """
+    Time a stage of the trace that is going on, if it is sampled
+    """
+    if not _sample_rate:
+        return NULL_SPAN
+    current = _current.get()
+    if current is None:
+        return NULL_SPAN
+    return Span(current, name, args)
@@ -0,0 +1,16 @@
+#!/usr/bin/env false
+"""
+Entry point for WSGI servers, e.g.
+
+    gunicorn --workers 4 spotiserver.wsgi:app
+
+Set STATE_STORE=sqlite so that the workers share one party.
+"""
+import logging
+import coloredlogs
+from . import create_party, read_config, start_party, server
+
+coloredlogs.install(level=logging.INFO)
+start_party(create_party(read_config()))
+
+app = server.app
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import pytest
+from spotiserver.client import CallScheduler
+from benchmarks.bench import make_party
+from benchmarks.fake_spotify import FakeSpotify
+
+# the asyncio serving mode needs the extras in requirements-asgi.txt
+httpx = pytest.importorskip('httpx')
+from spotiserver import asgi  # noqa: E402
+from spotiserver.aio import AsyncDJ, AsyncSpotify  # noqa: E402
+
+
+def make_app():
+    """
+    An ASGI app whose async client calls a FakeSpotify, the way the Flask
+    server's DJ does in the benchmarks
+    """
+    fake = FakeSpotify(explicit_rate=0)
+
+    def spotify(request):
+        path = str(request.url).replace(AsyncSpotify.prefix, '').split('?')[0]
+        params = {key: int(value) if value.isdigit() else value for key, value in request.url.params.items()}
+        payload = json.loads(request.content) if request.content else None
+        return httpx.Response(200, json=fake._call(request.method, path, payload, params))
+
+    fyre = make_party(fake)
+    sp = AsyncSpotify(scheduler=CallScheduler(rate=1e9, burst=1e9))
+    sp._session = httpx.AsyncClient(transport=httpx.MockTransport(spotify))
+    app = asgi.App()
+    app.party, app.sp, app.dj = fyre, sp, AsyncDJ(fyre.dj, sp)
+    return app, fake
+
+
+def test_requests_round_trip_to_the_queue():
+    app, fake = make_app()
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://party') as client:
+            r = await client.get('/request', params={'listener': 'ann', 'track': 'Human', 'artist': 'The Killers'})
+            assert r.status_code == 200 and r.json()['ok']
+
+            r = await client.post('/requests', json=[
+                {'listener': 'bob', 'track': 'Human', 'artist': 'The Killers'},
+                {'listener': 'cat', 'track': 'Umbrella'},
+                {'listener': 'dan', 'track': 'nothing like it'},
+            ])
+            assert r.status_code == 200
+            assert [result['ok'] for result in r.json()['results']] == [True, True, False]
+
+            r = await client.post('/requests', json=[{'listener': 'eve', 'track': 'Umbrella'}, {'listener': 'eve', 'track': 5}])
+            assert r.status_code == 400
+
+            r = await client.get('/queue')
+            assert r.status_code == 200
+            queue = r.json()['queue']
+            assert [track['votes'] for track in queue] == [2, 1]
+            assert fake.calls['GET search'] == 3
+
+            r = await client.get('/queue', headers={'If-None-Match': r.headers['etag']})
+            assert r.status_code == 304
+        await app.sp.close()
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+from spotiserver.catalog import TrackCatalog, trigrams, words
+from spotiserver.metadata import TrackInfo
+
+
+def info(track_id, name, artists):
+    return TrackInfo(track_id, name, artists, 'spotify:track:' + track_id, False, 200)
+
+
+def make_catalog(size=100):
+    catalog = TrackCatalog(size=size)
+    catalog.add_all([
+        info('brightside', 'Mr. Brightside', 'The Killers'),
+        info('human', 'Human', 'The Killers'),
+        info('human2', 'Human', "Rag'n'Bone Man"),
+        info('dancing', 'Dancing Queen', 'ABBA'),
+        info('umbrella', 'Umbrella', 'Rihanna, JAY-Z'),
+    ])
+    return catalog
+
+
+def test_words_and_trigrams():
+    assert words("Mr. Brightside!") == words('mr  brightside') == 'mr brightside'
+    assert trigrams('ab') == {' ab', 'ab '}
+    assert trigrams('') == set()
+
+
+def test_exact_title_ignores_case_and_punctuation():
+    catalog = make_catalog()
+    assert catalog.find('mr brightside').track_id == 'brightside'
+    assert catalog.find('MR. BRIGHTSIDE', 'the killers').track_id == 'brightside'
+
+
+def test_artist_picks_between_tracks_with_the_same_title():
+    catalog = make_catalog()
+    assert catalog.find('Human', 'The Killers').track_id == 'human'
+    assert catalog.find('human', "rag'n'bone man").track_id == 'human2'
+    assert catalog.find('Human', 'Someone Else') is None
+    # without an artist, either song could be meant
+    assert catalog.find('Human') is None
+
+
+def test_short_titles_need_an_artist_to_match_loosely():
+    catalog = make_catalog()
+    catalog.add(info('loveme', 'Love Me', 'Someone'))
+    assert catalog.find('Love') is None
+    assert catalog.find('Love', 'Someone').track_id == 'loveme'
+
+
+def test_several_songs_matching_loosely_are_a_miss():
+    catalog = make_catalog()
+    catalog.add(info('dancing2', 'Dancing Queens', 'Someone'))
+    assert catalog.find('Dancing Quen') is None
+
+
+def test_copies_of_a_song_resolve_to_the_first_added():
+    catalog = make_catalog()
+    catalog.add(info('human3', 'Human', 'The Killers'))
+    catalog.add(info('umbrella2', 'Umbrella', 'Rihanna, JAY-Z'))
+    for _ in range(10):
+        assert catalog.find('Human', 'The Killers').track_id == 'human'
+        assert catalog.find('Umbrela', 'Rihanna').track_id == 'umbrella'
+
+
+def test_typos_and_artist_in_title():
+    catalog = make_catalog()
+    assert catalog.find('Dancing Quen').track_id == 'dancing'
+    assert catalog.find('Dancing Queen ABBA').track_id == 'dancing'
+    # naming one of the track's artists is enough
+    assert catalog.find('Umbrela', 'Rihanna').track_id == 'umbrella'
+    assert catalog.find('Something else entirely') is None
+    assert catalog.hits == 3 and catalog.misses == 1
+
+
+def test_least_recently_seen_tracks_are_forgotten():
+    catalog = make_catalog(size=5)
+    # seeing a track again keeps it
+    catalog.add(info('brightside', 'Mr. Brightside', 'The Killers'))
+    catalog.add(info('new', 'New Song', 'Someone'))
+    assert len(catalog) == 5
+    assert catalog.find('Human', 'The Killers') is None
+    assert catalog.find('Mr Brightside').track_id == 'brightside'
+    # nothing is left in the index for the forgotten track
+    assert all('human' not in ids for ids in catalog._index.values())
+    assert catalog._titles['human'] == {'human2'}
@@ -0,0 +1,27 @@
+from spotiserver.history import PlayedHistory
+from spotiserver.store import SQLiteStore
+
+
+def test_oldest_tracks_are_forgotten():
+    history = PlayedHistory(size=3)
+    history.add_all(['a', 'b', 'a', 'c', 'd'])
+    assert 'a' in history and 'b' not in history and len(history) == 3
+
+
+def test_history_is_shared_through_the_store(tmp_path):
+    path = str(tmp_path / 'party.db')
+    leader = PlayedHistory(size=3, store=SQLiteStore(path))
+    follower = PlayedHistory(size=3, store=SQLiteStore(path))
+    assert 'a' not in follower
+
+    leader.add_all(['a', 'b'])
+    # the follower only catches up every so often
+    assert 'a' not in follower
+    follower.refresh()
+    assert 'a' in follower and 'b' in follower
+
+    follower.add('c')
+    leader.add('d')
+    assert 'c' in leader and 'a' not in leader
+    follower.refresh()
+    assert list(follower._order) == list(leader._order) == ['b', 'c', 'd']
@@ -0,0 +1,44 @@
+import threading
+import types
+import pytest
+from spotiserver.intake import Intake, IntakeFull, Ticket
+
+
+class SlowBouncer:
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def request(self, guest_key, title, artist):
+        self.release.wait(5)
+
+
+def make_intake(**kwargs):
+    bouncer = SlowBouncer()
+    return Intake(types.SimpleNamespace(bouncer=bouncer), workers=1, **kwargs), bouncer
+
+
+def test_full_intake_turns_requests_away():
+    intake, bouncer = make_intake(max_pending=3)
+    tickets = [intake.submit('guest', 'track {}'.format(i)) for i in range(3)]
+    with pytest.raises(IntakeFull):
+        intake.submit('guest', 'one too many')
+
+    bouncer.release.set()
+    intake._pool.shutdown(wait=True)
+    assert intake.pending == 0
+    assert all(ticket.status == Ticket.ACCEPTED for ticket in tickets)
+    intake.open('guest', 'room again')
+
+
+def test_pending_tickets_are_not_forgotten():
+    intake, bouncer = make_intake(max_tickets=5, max_pending=10)
+    pending = [intake.open('guest', 'pending {}'.format(i)) for i in range(3)]
+    for i in range(10):
+        intake.close(intake.open('guest', 'resolved {}'.format(i)))
+
+    assert len(intake._tickets) == 5
+    for ticket in pending:
+        assert intake.status(ticket.ticket_id) is ticket
+    # the newest resolved tickets are kept
+    assert [ticket.title for ticket in intake._tickets.values() if ticket.status != Ticket.PENDING] == ['resolved 8', 'resolved 9']
@@ -0,0 +1,94 @@
+import json
+import time
+from spotiserver.journal import Journal
+from spotiserver.store import MemoryStore
+
+
+def restart(path):
+    store = MemoryStore()
+    journal = Journal(path)
+    journal.recover(store)
+    store.journal = journal
+    journal.start(store)
+    return store, journal
+
+
+def wait_written(journal, seq, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with open(journal.path) as f:
+            lines = f.read().splitlines()
+        if lines and json.loads(lines[-1])[0] >= seq:
+            return
+        time.sleep(0.01)
+    raise AssertionError("journal was not written up to record {}".format(seq))
+
+
+def test_recover_replays_records(tmp_path):
+    path = str(tmp_path / 'party.journal')
+    store, journal = restart(path)
+    for i in range(5):
+        store.count_request('guest{}'.format(i % 2))
+        store.add_vote('track{}'.format(i), 'guest{}'.format(i % 2))
+        store.enqueue('track{}'.format(i))
+    store.pop_track()
+    wait_written(journal, journal.seq)
+
+    recovered, _ = restart(path)
+    assert recovered.dump() == store.dump()
+    assert recovered.total == 5
+
+
+def test_torn_last_line_is_cut_off(tmp_path):
+    path = str(tmp_path / 'party.journal')
+    store, journal = restart(path)
+    for i in range(5):
+        store.count_request('guest')
+    wait_written(journal, 5)
+
+    # a crash in the middle of writing a record
+    with open(path, 'a') as f:
+        f.write('[6,"r","gu')
+
+    store, journal = restart(path)
+    assert store.total == 5
+    with open(path) as f:
+        assert f.read().endswith('[5,"r","guest"]\n')
+    for i in range(5):
+        store.count_request('guest')
+    wait_written(journal, 10)
+
+    store, _ = restart(path)
+    assert store.total == 10
+
+
+def test_record_without_newline_is_torn(tmp_path):
+    path = str(tmp_path / 'party.journal')
+    with open(path, 'w') as f:
+        f.write('[1,"r","guest"]\n[2,"r","guest"]')
+
+    store, journal = restart(path)
+    assert store.total == 1
+    with open(path) as f:
+        assert f.read() == '[1,"r","guest"]\n'
+    store.count_request('guest')
+    wait_written(journal, 2)
+
+    store, _ = restart(path)
+    assert store.total == 2
+
+
+def test_snapshot_covers_earlier_records(tmp_path):
+    path = str(tmp_path / 'party.journal')
+    store, journal = restart(path)
+    store.count_request('guest')
+    store.add_vote('track', 'guest')
+    store.enqueue('track')
+    wait_written(journal, journal.seq)
+    journal.compact(store)
+    store.count_request('guest')
+    wait_written(journal, journal.seq)
+
+    recovered, _ = restart(path)
+    assert recovered.total == 2
+    assert recovered.queued_tracks() == [('track', 1)]
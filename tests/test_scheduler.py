@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+import pytest
+import spotipy
+from spotiserver.client import CallScheduler, RateLimited
+
+
+def drain(scheduler):
+    scheduler._tokens = 0
+    scheduler._updated = time.monotonic()
+
+
+def test_priorities():
+    assert CallScheduler.priority('GET', 'search') == CallScheduler.SEARCH
+    assert CallScheduler.priority('GET', 'me/player') == CallScheduler.PLAYBACK
+    assert CallScheduler.priority('POST', 'users/{id}/playlists/{id}/tracks') == CallScheduler.PLAYBACK
+    assert CallScheduler.priority('GET', 'users/{id}/playlists/{id}/tracks') == CallScheduler.BACKGROUND
+    assert CallScheduler.priority('GET', 'recommendations') == CallScheduler.BACKGROUND
+
+
+def test_searches_leave_the_reserve():
+    scheduler = CallScheduler(rate=0.01, burst=10, reserve=5, search_wait=0.1)
+    for i in range(5):
+        scheduler.acquire(CallScheduler.SEARCH)
+    with pytest.raises(RateLimited):
+        scheduler.acquire(CallScheduler.SEARCH)
+    # the reserve is still there for the calls that keep the music playing
+    for i in range(5):
+        scheduler.acquire(CallScheduler.PLAYBACK)
+
+
+def test_search_that_would_wait_too_long_is_shed():
+    scheduler = CallScheduler(rate=1, burst=5, reserve=0, search_wait=0.2)
+    drain(scheduler)
+    started = time.monotonic()
+    with pytest.raises(RateLimited):
+        scheduler.acquire(CallScheduler.SEARCH)
+    # shed right away, since no token would be free in time
+    assert time.monotonic() - started < 0.1
+
+
+def test_search_waits_for_a_token_in_time():
+    scheduler = CallScheduler(rate=20, burst=5, reserve=0, search_wait=1)
+    drain(scheduler)
+    started = time.monotonic()
+    scheduler.acquire(CallScheduler.SEARCH)
+    assert 0.03 < time.monotonic() - started < 0.5
+
+
+def test_higher_priority_goes_first():
+    scheduler = CallScheduler(rate=10, burst=5, reserve=0)
+    drain(scheduler)
+    order = []
+
+    def call(priority):
+        scheduler.acquire(priority)
+        order.append(priority)
+
+    threads = [threading.Thread(target=call, args=(CallScheduler.BACKGROUND,))]
+    threads[0].start()
+    time.sleep(0.02)
+    threads.append(threading.Thread(target=call, args=(CallScheduler.PLAYBACK,)))
+    threads[1].start()
+    for thread in threads:
+        thread.join(5)
+    assert order == [CallScheduler.PLAYBACK, CallScheduler.BACKGROUND]
+    assert scheduler._waiting == [0, 0, 0]
+
+
+def test_searches_wait_behind_background_calls_async():
+    scheduler = CallScheduler(rate=10, burst=5, reserve=0, search_wait=2)
+    drain(scheduler)
+    order = []
+
+    async def call(priority, delay):
+        await asyncio.sleep(delay)
+        await scheduler.acquire_async(priority)
+        order.append(priority)
+
+    async def main():
+        await asyncio.gather(call(CallScheduler.SEARCH, 0), call(CallScheduler.BACKGROUND, 0.02))
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert order == [CallScheduler.BACKGROUND, CallScheduler.SEARCH]
+    # the search goes as soon as the next token is free, not at its deadline
+    assert time.monotonic() - started < 1
+    assert scheduler._waiting == [0, 0, 0]
+
+
+def error(status, retry_after=None):
+    headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+    return spotipy.client.SpotifyException(status, -1, 'error', headers=headers)
+
+
+def test_retry_delay():
+    scheduler = CallScheduler()
+    # server errors are retried with growing delays, for GETs only
+    assert scheduler.retry_delay(CallScheduler.BACKGROUND, 'GET', error(502), 2, 3) == 2
+    with pytest.raises(spotipy.client.SpotifyException):
+        scheduler.retry_delay(CallScheduler.PLAYBACK, 'POST', error(502), 1, 3)
+    with pytest.raises(spotipy.client.SpotifyException):
+        scheduler.retry_delay(CallScheduler.BACKGROUND, 'GET', error(404), 1, 3)
+    with pytest.raises(spotipy.client.SpotifyException):
+        scheduler.retry_delay(CallScheduler.BACKGROUND, 'GET', error(502), 4, 3)
+
+
+def test_429_holds_every_call():
+    scheduler = CallScheduler(rate=1000, burst=20, search_wait=0.1)
+    # a search gives up right away
+    with pytest.raises(RateLimited) as raised:
+        scheduler.retry_delay(CallScheduler.SEARCH, 'GET', error(429, retry_after=1), 1, 3)
+    assert raised.value.retry_after == 1
+    with pytest.raises(RateLimited):
+        scheduler.acquire(CallScheduler.SEARCH)
+
+    # other calls wait out the Retry-After
+    scheduler._blocked_until = time.monotonic() + 0.2
+    assert scheduler.retry_delay(CallScheduler.PLAYBACK, 'GET', error(429, retry_after=0), 1, 3) == 0
+    started = time.monotonic()
+    scheduler.acquire(CallScheduler.PLAYBACK)
+    assert time.monotonic() - started >= 0.15
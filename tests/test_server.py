@@ -0,0 +1,50 @@
+import json
+import types
+from spotiserver import server
+
+
+class RecordingBouncer:
+
+    def __init__(self):
+        self.batches = []
+
+    def request_batch(self, requests):
+        self.batches.append(requests)
+        return [None] * len(requests)
+
+
+def post_batch(batch):
+    bouncer = RecordingBouncer()
+    server.app.party = types.SimpleNamespace(bouncer=bouncer)
+    response = server.app.test_client().post('/requests', json=batch)
+    return response, bouncer
+
+
+def test_batch_of_valid_requests_is_admitted():
+    response, bouncer = post_batch([
+        {'listener': 'ann', 'track': 'Human'},
+        {'listener': 'bob', 'track': 'Human', 'artist': 'The Killers'},
+        {'listener': 'cat', 'track': 'Umbrella', 'artist': None},
+    ])
+    assert response.status_code == 200
+    assert [result['ok'] for result in json.loads(response.data)['results']] == [True, True, True]
+    assert bouncer.batches == [[('ann', 'Human', None), ('bob', 'Human', 'The Killers'), ('cat', 'Umbrella', None)]]
+
+
+def test_batch_with_an_invalid_request_is_turned_away():
+    for invalid in [{'listener': 'bob', 'track': 5},
+                    {'listener': None, 'track': 'Human'},
+                    {'listener': 'bob', 'track': '  '},
+                    {'listener': 'bob', 'track': 'Human', 'artist': ''},
+                    {'track': 'Human'},
+                    'Human']:
+        response, bouncer = post_batch([{'listener': 'ann', 'track': 'Human'}, invalid])
+        assert response.status_code == 400, invalid
+        assert json.loads(response.data)['ok'] is False
+        assert bouncer.batches == []
+
+
+def test_body_must_be_an_array():
+    response, bouncer = post_batch({'listener': 'ann', 'track': 'Human'})
+    assert response.status_code == 400
+    assert bouncer.batches == []
@@ -0,0 +1,148 @@
+import random
+import time
+import pytest
+from spotiserver.store import MemoryStore, SQLiteStore
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def tick(self, seconds=1):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # the stores see the same times, and tracks created a tick apart, so
+    # ties in votes are broken the same way in each store
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock.time)
+    return clock
+
+
+def make_stores(tmp_path, half_life=0):
+    stores = [MemoryStore(), SQLiteStore(str(tmp_path / 'party.db'))]
+    for store in stores:
+        store.half_life = half_life
+    return stores
+
+
+def play(store, clock, seed, steps=2000):
+    """
+    Vote, enqueue and pop at random, like a party would
+
+    :return: the tracks popped, in order
+    """
+    rnd = random.Random(seed)
+    popped = []
+    for step in range(steps):
+        clock.tick()
+        op = rnd.random()
+        if op < 0.8:
+            track_id = 'track{}'.format(rnd.randrange(100))
+            guest_key = 'guest{}'.format(rnd.randrange(30))
+            with store.transaction():
+                store.count_request(guest_key)
+                store.add_vote(track_id, guest_key)
+                if not store.is_queued(track_id):
+                    store.enqueue(track_id)
+        else:
+            popped.append(store.pop_track()[0])
+    return popped
+
+
+@pytest.mark.parametrize('half_life', [0, 600])
+def test_stores_pop_the_same_tracks(tmp_path, clock, half_life):
+    memory, sqlite = make_stores(tmp_path, half_life)
+    popped = play(memory, clock, 1)
+    clock.now = 1000000.0
+    assert popped == play(sqlite, clock, 1)
+
+    assert memory.queued_tracks(limit=1000) == [tuple(row) for row in sqlite.queued_tracks(limit=1000)]
+    assert memory.queue_length() == sqlite.queue_length()
+    assert memory.total_requests() == sqlite.total_requests()
+    assert memory.guest_count() == sqlite.guest_count()
+    for i in range(30):
+        assert memory.guest_requests('guest{}'.format(i)) == sqlite.guest_requests('guest{}'.format(i))
+        assert memory.track_votes('track{}'.format(i), 'guest{}'.format(i)) == \
+            sqlite.track_votes('track{}'.format(i), 'guest{}'.format(i))
+
+    drained = [[], []]
+    for store, tracks in zip((memory, sqlite), drained):
+        track_id, queued_at = store.pop_track()
+        while track_id:
+            assert queued_at is not None
+            tracks.append(track_id)
+            track_id, queued_at = store.pop_track()
+    assert drained[0] == drained[1]
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_pop_order(tmp_path, clock, index):
+    store = make_stores(tmp_path)[index]
+    for track_id, votes in [('a', 1), ('b', 3), ('c', 2), ('d', 3), ('e', 1)]:
+        clock.tick()
+        for i in range(votes):
+            store.add_vote(track_id, 'guest{}'.format(i))
+        store.enqueue(track_id)
+    # most votes first, and the newest track first among equals
+    assert [store.pop_track()[0] for i in range(5)] == ['d', 'b', 'c', 'e', 'a']
+    assert store.pop_track() == (None, None)
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_decayed_votes(tmp_path, clock, index):
+    store = make_stores(tmp_path, half_life=10)[index]
+    store.add_vote('old', 'guest1')
+    store.add_vote('old', 'guest2')
+    store.enqueue('old')
+    # one vote is worth more than two made 20 seconds earlier
+    clock.tick(20)
+    store.add_vote('new', 'guest3')
+    store.enqueue('new')
+    assert [track_id for track_id, votes in store.queued_tracks()] == ['new', 'old']
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_queue_version(tmp_path, clock, index):
+    store = make_stores(tmp_path)[index]
+    versions = [store.queue_version()]
+    store.add_vote('a', 'guest')
+    assert store.queue_version() == versions[-1]
+    store.enqueue('a')
+    versions.append(store.queue_version())
+    store.add_vote('a', 'other')
+    versions.append(store.queue_version())
+    store.pop_track()
+    versions.append(store.queue_version())
+    assert len(set(versions)) == 4
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_played_tracks(tmp_path, clock, index):
+    store = make_stores(tmp_path)[index]
+    assert store.played_since(0) == []
+    store.add_played(['a', 'b'], keep=3)
+    store.add_played(['c', 'd'], keep=3)
+    played = store.played_since(0)
+    assert [track_id for seq, track_id in played] == ['b', 'c', 'd']
+    assert [track_id for seq, track_id in store.played_since(played[1][0])] == ['d']
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_now_playing(tmp_path, clock, index):
+    store = make_stores(tmp_path)[index]
+    assert store.now_playing() is None
+    version = store.queue_version()
+    store.set_playing({'id': 'a', 'name': 'Song A'})
+    assert store.now_playing() == {'id': 'a', 'name': 'Song A'}
+    assert store.queue_version() != version
+    # the same track again is not a change
+    version = store.queue_version()
+    store.set_playing({'id': 'a', 'name': 'Song A'})
+    assert store.queue_version() == version
@@ -0,0 +1,84 @@
+import random
+from spotiserver.party import Track, TrackQueue
+
+
+def check_invariants(queue):
+    heap = queue._heap
+    assert len(queue._index) == len(heap)
+    for pos, track in enumerate(heap):
+        assert queue._index[track.spotify_id] == pos
+        for child in (2 * pos + 1, 2 * pos + 2):
+            if child < len(heap):
+                assert not heap[child] < track
+
+
+def make_tracks(count):
+    tracks = []
+    for i in range(count):
+        track = Track('track{}'.format(i))
+        # distinct creation times, so ties in votes have a defined order
+        track._time_created = i
+        tracks.append(track)
+    return tracks
+
+
+def test_pop_order():
+    rnd = random.Random(1)
+    queue = TrackQueue()
+    tracks = make_tracks(200)
+    for track in tracks:
+        for i in range(rnd.randrange(5)):
+            track.vote('guest{}'.format(i))
+        queue.push(track)
+        check_invariants(queue)
+
+    popped = []
+    while queue:
+        popped.append(queue.pop())
+        check_invariants(queue)
+    assert popped == sorted(tracks)
+    # most votes first, and the newest track first among equals
+    assert [(track.votes, track._time_created) for track in popped] == \
+        sorted(((track.votes, track._time_created) for track in tracks), reverse=True)
+
+
+def test_update_remove_pop():
+    rnd = random.Random(2)
+    queue = TrackQueue()
+    tracks = make_tracks(300)
+    queued = set()
+    for step in range(3000):
+        track = rnd.choice(tracks)
+        op = rnd.random()
+        if track not in queue:
+            queue.push(track)
+            queued.add(track.spotify_id)
+        elif op < 0.6:
+            track.vote('guest{}'.format(step))
+            queue.update(track)
+        elif op < 0.8:
+            queue.remove(track)
+            queued.discard(track.spotify_id)
+        else:
+            first = queue.pop()
+            assert all(not other < first for other in queue)
+            queued.discard(first.spotify_id)
+        check_invariants(queue)
+        assert set(queue._index) == queued
+        assert all((track in queue) == (track.spotify_id in queued) for track in tracks)
+
+
+def test_remove_last_and_only():
+    queue = TrackQueue()
+    track, = make_tracks(1)
+    queue.push(track)
+    queue.remove(track)
+    assert not queue and track not in queue
+    check_invariants(queue)
+
+    tracks = make_tracks(3)
+    for track in tracks:
+        queue.push(track)
+    queue.remove(queue._heap[-1])
+    check_invariants(queue)
+    assert len(queue) == 2